@@ -4,7 +4,14 @@
 import os
 import json
 import re
+import sys
+import signal
+import socket
+import argparse
+import threading
+import concurrent.futures
 import subprocess
+import tempfile
 import time
 from datetime import datetime
 
@@ -17,7 +24,8 @@ from datetime import datetime
 # /etc/ssh/sshd_config
 # GatewayPorts yes
 #
-# Also install netstat on the remote server (apt-get install net-tools)
+# The tunnels are checked by reading /proc/net/tcp on the remote server, which
+# must therefore run Linux.
 #
 # After all of this, delete pending connections and restart sshd daemon (service sshd restart)
 #
@@ -28,23 +36,392 @@ from datetime import datetime
 CURRENT_DIRECTORY_PATH = os.path.realpath(os.path.dirname(__file__))
 PATH_LOG = os.path.join(CURRENT_DIRECTORY_PATH, "bridge.log")
 PATH_CONFIG = os.path.join(CURRENT_DIRECTORY_PATH, ".bridge.json")
+PATH_DAEMON_PID = os.path.join(CURRENT_DIRECTORY_PATH, ".bridge-daemon.pid")
+
+# Maximum duration of a check over the control connection, a hung connection is considered broken
+CHECK_TIMEOUT_S = 15
+# Maximum duration of the connection to a forwarded port
+PROBE_TIMEOUT_S = 5
+
+# SSH options followed by a value
+SSH_OPTIONS_WITH_VALUE = "BbcDEeFIiJLlmOoPpQRSWw"
+
+# Tunnels run in parallel, log lines must not be interleaved
+logLock = threading.Lock()
+
+"""
+Execute process, with sshErrorOnly the exit code of the remote command is ignored and only ssh failing (255) is an error
+"""
+def shell(command, timeout=None, sshErrorOnly=False):
+	proc = subprocess.run(command, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+	if proc.returncode == 255 if sshErrorOnly else proc.returncode != 0:
+		raise Exception(proc.stderr)
+	return proc.stdout
+
+"""
+Source and destination ports of a port mapping
+"""
+def getPortMapping(port):
+	portList = str(port).split(":")
+	assert len(portList) <= 2, "Wrong format for port '%s'" % (str(port))
+	return int(portList[0]), int(portList[1] if len(portList) == 2 else portList[0])
 
 """
-Execute process
+Host of the SSH destination, the first argument which is neither an option nor an option value
 """
-def shell(command, noWait=False):
-	proc = subprocess.Popen(command, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	if noWait:
-		time. sleep(2)
+def getSshHost(argList):
+	isValue = False
+	for arg in argList:
+		if isValue:
+			isValue = False
+		elif arg.startswith("-"):
+			# Options are combined (-NT) and their value is either attached (-p2222) or the next argument
+			for index, option in enumerate(arg[1:]):
+				if option in SSH_OPTIONS_WITH_VALUE:
+					isValue = (index == len(arg) - 2)
+					break
+		else:
+			destination = arg[len("ssh://"):] if arg.startswith("ssh://") else arg
+			host = destination.split("@")[-1]
+			return host.rsplit(":", 1)[0] if arg.startswith("ssh://") else host
+	raise Exception("No SSH destination in '%s'" % (" ".join(argList)))
+
+"""
+Pid of the process from a pidfile, None if not running
+"""
+def readPid(path):
+	try:
+		with open(path, "r") as f:
+			pid = int(f.read().strip())
+		os.kill(pid, 0)
+		return pid
+	except (OSError, ValueError):
+		return None
+
+"""
+Arguments of the command line of a process, None if not running
+"""
+def readCommandLine(pid):
+	try:
+		with open("/proc/%i/cmdline" % (pid), "rb") as f:
+			return f.read().decode(errors="replace").split("\0")
+	except OSError:
+		return None
 
-	if proc.poll() or noWait == False:
-		(stdout, stderr) = proc.communicate()
-		exitCode = proc.returncode
-		if exitCode != 0:
-			raise Exception(stderr)
-		return stdout
+"""
+Pid of the running daemon, None if not running. As for the tunnels, the pid of a daemon killed without
+cleaning up (reboot, out of memory) may have been reused by another process.
+"""
+def readDaemonPid():
+	pid = readPid(PATH_DAEMON_PID)
+	argList = readCommandLine(pid) if pid else None
+	if argList is None or "--daemon" not in argList or os.path.basename(__file__) not in [os.path.basename(arg) for arg in argList]:
+		return None
+	return pid
 
-	return ""
+"""
+Human readable duration
+"""
+def formatDuration(durationS):
+	hours, remainder = divmod(int(durationS), 3600)
+	return "%ih%02im%02is" % (hours, remainder // 60, remainder % 60)
+
+"""
+Reverse SSH tunnel forwarding a group of ports, run under its own control socket
+"""
+class Tunnel:
+	def __init__(self, config):
+		self.name = config.get("name", "")
+		self.authList = config["auth"] if isinstance(config["auth"], list) else config["auth"].split()
+		self.portList = config["ports"]
+		# Host on which the forwarded ports are probed (GatewayPorts), by default the SSH host
+		self.probeHost = config.get("probeHost") or getSshHost(self.authList)
+		# An unnamed tunnel keeps the paths of the single tunnel configuration
+		suffix = ".%s" % (self.name) if self.name else ""
+		self.controlPath = os.path.join(CURRENT_DIRECTORY_PATH, ".bridge%s.ctl" % (suffix))
+		self.pidPath = os.path.join(CURRENT_DIRECTORY_PATH, ".bridge%s.pid" % (suffix))
+
+	def __str__(self):
+		return "'%s' (%s)" % (self.name, " ".join(self.authList)) if self.name else " ".join(self.authList)
+
+	"""
+	SSH command using the control socket of the tunnel
+	"""
+	def sshCommand(self, optionList):
+		return ["ssh", "-o", "StrictHostKeyChecking no", "-o", "ControlPath=%s" % (self.controlPath)] + optionList + self.authList
+
+	"""
+	SSH command creating the tunnel as master of the control socket
+	"""
+	def tunnelCommand(self, optionList):
+		command = self.sshCommand(["-o", "ControlMaster yes", "-o", "ExitOnForwardFailure yes"] + optionList)
+		for port in self.portList:
+			command += ["-R", "{}:localhost:{}".format(*getPortMapping(port))]
+		return command
+
+	"""
+	Pid of the SSH master owning the tunnel from its pidfile, None if not running. The command line of the process
+	is checked, the pid of a master which died may have been reused by an unrelated process.
+	"""
+	def readMasterPid(self):
+		pid = readPid(self.pidPath)
+		argList = readCommandLine(pid) if pid else None
+		if argList is None or os.path.basename(argList[0]) != "ssh" or ("ControlPath=%s" % (self.controlPath)) not in argList:
+			return None
+		return pid
+
+	"""
+	Pids of the tunnels started by the versions without control socket (ssh -nfNT <auth>), found from their command line
+	"""
+	def findLegacyPidList(self):
+		pidList = []
+		for name in os.listdir("/proc"):
+			argList = readCommandLine(int(name)) if name.isdigit() else None
+			if not argList or os.path.basename(argList[0]) != "ssh" or "-nfNT" not in argList or any(arg.startswith("ControlPath=") for arg in argList):
+				continue
+			index = argList.index("-nfNT") + 1
+			if argList[index:index + len(self.authList)] == self.authList:
+				pidList.append(int(name))
+		return pidList
+
+	"""
+	Start the tunnel under a control socket, ssh only goes to background once all the forwards are established
+	"""
+	def start(self):
+		logPrint("bridge", "Creating bridge %s on port(s) %s" % (str(self), ", ".join([str(port) for port in self.portList])))
+
+		# The background process keeps the standard outputs, they cannot be pipes
+		with tempfile.TemporaryFile() as errorFile:
+			proc = subprocess.run(self.tunnelCommand(["-nfNT"]), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=errorFile)
+			if proc.returncode != 0:
+				errorFile.seek(0)
+				raise Exception(errorFile.read())
+
+		# ssh forked, the pid of the master comes from the control socket
+		output = subprocess.run(self.sshCommand(["-O", "check"]), capture_output=True, timeout=CHECK_TIMEOUT_S).stderr.decode()
+		match = re.search(r"pid=(\d+)", output)
+		if match:
+			with open(self.pidPath, "w") as f:
+				f.write(match.group(1))
+
+	"""
+	Stop the tunnel, gracefully through the control socket or by killing the master process. The master is proc when
+	owned by the daemon: it is only killed while not reaped, its pid may have been reused afterwards.
+	"""
+	def stop(self, proc=None):
+		if proc is not None:
+			if proc.poll() is None:
+				proc.kill()
+			proc.wait()
+		else:
+			try:
+				subprocess.run(self.sshCommand(["-O", "exit"]), capture_output=True, timeout=CHECK_TIMEOUT_S)
+			except subprocess.TimeoutExpired:
+				pass
+			pid = self.readMasterPid()
+			if pid:
+				os.kill(pid, signal.SIGKILL)
+			# A tunnel left by a version without control socket holds the remote ports, it has no pidfile
+			elif not os.path.exists(self.pidPath):
+				for legacyPid in self.findLegacyPidList():
+					logPrint("bridge", "Killing tunnel %s started by a previous version (pid %i)" % (str(self), legacyPid))
+					try:
+						os.kill(legacyPid, signal.SIGKILL)
+					except ProcessLookupError:
+						pass
+		for path in (self.controlPath, self.pidPath):
+			if os.path.exists(path):
+				os.remove(path)
+
+	"""
+	Remote ports listening, read from /proc/net/tcp through the control connection (no new login)
+	"""
+	def getRemoteListeningPorts(self):
+		# /proc/net/tcp6 does not exist if IPv6 is disabled, cat then fails but still prints /proc/net/tcp
+		output = shell(self.sshCommand(["-o", "ControlMaster no", "-T"]) + ["cat", "/proc/net/tcp", "/proc/net/tcp6", "2>/dev/null"],
+				timeout=CHECK_TIMEOUT_S, sshErrorOnly=True)
+		portSet = set()
+		for line in output.decode().splitlines():
+			fieldList = line.split()
+			# Fields: sl local_address rem_address st ..., 0A is the LISTEN state
+			if len(fieldList) > 3 and fieldList[3] == "0A":
+				portSet.add(int(fieldList[1].split(":")[-1], 16))
+		return portSet
+
+	"""
+	Connect to a forwarded port, return the latency in ms or the error
+	"""
+	def probePort(self, port):
+		start = time.monotonic()
+		try:
+			with socket.create_connection((self.probeHost, getPortMapping(port)[0]), timeout=PROBE_TIMEOUT_S):
+				return (time.monotonic() - start) * 1000, None
+		except OSError as e:
+			return None, str(e) or type(e).__name__
+
+	"""
+	Check that the tunnel is running and that all its ports are forwarded, the ports are probed in parallel.
+	Return None if healthy or the reason why it is not, and the status of each port.
+	Only the ports not listening make the tunnel unhealthy, an unreachable port is not fixed by a restart.
+	"""
+	def check(self):
+		if self.readMasterPid() is None:
+			return "not running", []
+		try:
+			if subprocess.run(self.sshCommand(["-O", "check"]), capture_output=True, timeout=CHECK_TIMEOUT_S).returncode != 0:
+				return "control socket not responding", []
+			portSet = self.getRemoteListeningPorts()
+		except subprocess.TimeoutExpired:
+			return "no answer within %is" % (CHECK_TIMEOUT_S), []
+		except Exception as e:
+			return "probe failed: %s" % (str(e)), []
+
+		statusList = []
+		with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(self.portList), 1)) as executor:
+			probeList = [executor.submit(self.probePort, port) if self.probeHost else None for port in self.portList]
+			for port, probe in zip(self.portList, probeList):
+				latencyMs, error = probe.result() if probe else (None, None)
+				statusList.append({"port": port, "listening": getPortMapping(port)[0] in portSet, "latencyMs": latencyMs, "error": error})
+
+		missingList = [str(status["port"]) for status in statusList if not status["listening"]]
+		if missingList:
+			return "port(s) %s not listening" % (", ".join(missingList)), statusList
+		return None, statusList
+
+	"""
+	One line summary of the status of the ports
+	"""
+	def formatStatus(self, statusList):
+		portStatusList = []
+		for status in statusList:
+			if not status["listening"]:
+				portStatusList.append("%s not listening" % (status["port"]))
+			elif status["error"]:
+				portStatusList.append("%s unreachable (%s)" % (status["port"], status["error"]))
+			elif status["latencyMs"] is not None:
+				portStatusList.append("%s %.0fms" % (status["port"], status["latencyMs"]))
+			else:
+				portStatusList.append("%s listening" % (status["port"]))
+		return "Tunnel %s: %s" % (str(self), ", ".join(portStatusList))
+
+	"""
+	Check the tunnel and restart it if broken
+	"""
+	def ensure(self):
+		reason, statusList = self.check()
+		if statusList:
+			print(self.formatStatus(statusList))
+		if reason:
+			if reason != "not running":
+				logPrint("broken", "Unresponsive tunnel %s (%s), killing it" % (str(self), reason))
+			self.stop()
+			try:
+				self.start()
+			except Exception as e:
+				logPrint("error", "Failed while creating bridge %s with error: %s" % (str(self), str(e)))
+
+	"""
+	Supervise the tunnel as a child process until stopEvent is set: its exit is detected immediately, its health
+	checked every few seconds and it is restarted with an exponential backoff. Uptime and reconnection statistics are logged.
+	"""
+	def supervise(self, daemonConfig, stopEvent):
+		healthS = daemonConfig.get("healthSeconds", 30)
+		backoffMaxS = daemonConfig.get("backoffMaxSeconds", 300)
+		statsS = daemonConfig.get("statsHours", 6) * 3600
+
+		start = time.monotonic()
+		lastStats = start
+		uptimeS = 0.
+		nbReconnects = 0
+		backoffS = 1
+		statusList = []
+		sessionStart = None
+
+		def logStats():
+			totalS = time.monotonic() - start
+			# Include the current session
+			currentUptimeS = uptimeS + (time.monotonic() - sessionStart if sessionStart else 0)
+			logPrint("stats", "Tunnel %s uptime %.2f%% over %s, %i reconnection(s)" % (str(self), 100. * currentUptimeS / max(totalS, 1), formatDuration(totalS), nbReconnects))
+			if statusList:
+				logPrint("status", self.formatStatus(statusList))
+
+		while not stopEvent.is_set():
+			# A tunnel left by the one shot mode or a previous daemon would hold the ports
+			self.stop()
+			logPrint("bridge", "Creating bridge %s on port(s) %s" % (str(self), ", ".join([str(port) for port in self.portList])))
+			errorFile = tempfile.TemporaryFile()
+			proc = subprocess.Popen(self.tunnelCommand(["-o", "ServerAliveInterval %i" % (healthS), "-o", "ServerAliveCountMax 2", "-nNT"]),
+					stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=errorFile)
+			with open(self.pidPath, "w") as f:
+				f.write(str(proc.pid))
+			sessionStart = time.monotonic()
+			nextCheck = sessionStart + healthS
+
+			reason = None
+			while reason is None and not stopEvent.is_set():
+				try:
+					proc.wait(timeout=1)
+					errorFile.seek(0)
+					reason = "exited with code %i: %s" % (proc.returncode, errorFile.read().decode(errors="replace").strip()[-200:])
+				except subprocess.TimeoutExpired:
+					# The control socket only exists once connected
+					if time.monotonic() >= nextCheck and (os.path.exists(self.controlPath) or time.monotonic() - sessionStart > CHECK_TIMEOUT_S):
+						reason, statusList = self.check()
+						nextCheck = time.monotonic() + healthS
+				if time.monotonic() - lastStats > statsS:
+					logStats()
+					lastStats = time.monotonic()
+
+			sessionS = time.monotonic() - sessionStart
+			uptimeS += sessionS
+			sessionStart = None
+			self.stop(proc)
+			errorFile.close()
+			if stopEvent.is_set():
+				break
+
+			# A tunnel which stayed up long enough is not failing repeatedly, the backoff starts over
+			if sessionS > backoffMaxS:
+				backoffS = 1
+			nbReconnects += 1
+			logPrint("broken", "Tunnel %s down after %s (%s), reconnecting in %is" % (str(self), formatDuration(sessionS), reason, backoffS))
+			stopEvent.wait(backoffS)
+			backoffS = min(backoffS * 2, backoffMaxS)
+
+		logStats()
+
+"""
+Tunnels of the configuration, the single tunnel format (ports and auth at the top level) is still supported
+"""
+def getTunnelList(config):
+	if config.get("auth") and "ports" in config:
+		return [Tunnel({"auth": config["auth"], "ports": config["ports"]})]
+	tunnelList = [Tunnel(tunnelConfig) for tunnelConfig in config["tunnels"]]
+	nameList = [tunnel.name for tunnel in tunnelList]
+	assert len(set(nameList)) == len(nameList), "Tunnel names must be unique"
+	return tunnelList
+
+"""
+Supervise all the tunnels in parallel until terminated
+"""
+def runDaemon(tunnelList, daemonConfig):
+	with open(PATH_DAEMON_PID, "w") as f:
+		f.write(str(os.getpid()))
+	stopEvent = threading.Event()
+	signal.signal(signal.SIGTERM, lambda signum, frame: stopEvent.set())
+
+	threadList = [threading.Thread(target=tunnel.supervise, args=(daemonConfig, stopEvent)) for tunnel in tunnelList]
+	for thread in threadList:
+		thread.start()
+	try:
+		for thread in threadList:
+			thread.join()
+	except KeyboardInterrupt:
+		stopEvent.set()
+		for thread in threadList:
+			thread.join()
+	finally:
+		os.remove(PATH_DAEMON_PID)
 
 """
 Add entry to the log
@@ -52,24 +429,44 @@ Add entry to the log
 def logPrint(action, message):
 	entry = "[%s] [%s] %s" % (str(datetime.now()), action.upper(), message)
 	entry = entry.replace("\n", " ").replace("\r", "")
-	with open(PATH_LOG, "a") as f:
-		f.write(entry + "\n")
-	print(entry)
+	with logLock:
+		with open(PATH_LOG, "a") as f:
+			f.write(entry + "\n")
+		print(entry)
 
 if __name__ == '__main__':
 
+	parser = argparse.ArgumentParser(description="Reverse SSH tunnels to remote hosts.")
+	parser.add_argument("--daemon", action="store_true", help="Keep running and supervise the tunnels.")
+	args = parser.parse_args()
+
 	config = {
-		"ports": [
-			# List of ports to be forwarded.
-			# Should be written either as a list of port numbers or a string delimited
-			# by ":" specifiyng the port mapping.
+		"tunnels": [
+			{
+				# Name of the tunnel, must be unique
+				"name": "default",
+				# Authentication used for the SSH command
+				"auth": "admin@myserver.com",
+				# List of ports to be forwarded.
+				# Should be written either as a list of port numbers or a string delimited
+				# by ":" specifiyng the port mapping.
+				"ports": [],
+				# Host where the forwarded ports are probed, the SSH host by default, null to disable
+				#"probeHost": "myserver.com"
+			}
 		],
-		# Authentication used for the SSH command
-		"auth": "admin@myserver.com"
+		"daemon": {
+			# Interval of the health checks of the tunnels
+			"healthSeconds": 30,
+			# Maximum delay between two reconnections
+			"backoffMaxSeconds": 300,
+			# Interval of the uptime statistics in the log
+			"statsHours": 6
+		}
 	}
 
 	try:
-	
+
 		# Load the configuration
 		if not os.path.exists(PATH_CONFIG):
 			with open(PATH_CONFIG, "w") as f:
@@ -77,56 +474,25 @@ if __name__ == '__main__':
 		with open(PATH_CONFIG, "r") as f:
 			configUser = json.load(f)
 			config.update(configUser)
-	
-		# Generate the ssh command to connect to the target
-		command = ["ssh", "-o", "StrictHostKeyChecking no", "-nfNT"] + config["auth"]
-		for port in config["ports"]:
-			portList = str(port).split(":")
-			assert len(portList) <= 2, "Wrong format for port '%s'" % (str(port))
-			srcPort = portList[0]
-			dstPort = portList[1] if len(portList) == 2 else portList[0]
-			command += ["-R", "{}:localhost:{}".format(srcPort, dstPort)]
-	
-		# Check if process is running
-		processList = shell(["ps", "-eo", "pid,command"])
-		regexpr = r"ssh.*-nfNT\s+" + r"\s+".join([re.escape(str(cmd)) for cmd in config["auth"]]) + r"\b"
-		runningList = []
-		for process in processList.splitlines():
-			process = process.decode()
-			if re.search(regexpr, process, re.IGNORECASE):
-				pid = process.strip().split()[0]
-				runningList.append(pid)
-	
-		# If running
-		if len(runningList) > 0:
-	
-			# Check if the tunnel is still responsive
-			openPortList = shell(["ssh"] + config["auth"] + ["netstat", "-an"])
-			nbConnectionsActive = 0
-			for port in config["ports"]:
-				regexpr = r"tcp.*:\b" + re.escape(str(port).split(":")[0]) + r"\b.*LISTEN"
-				for openPort in openPortList.splitlines():
-					openPort = openPort.decode()
-					if re.search(regexpr, openPort, re.IGNORECASE):
-						nbConnectionsActive += 1
-						break
-			connectionActive = True if nbConnectionsActive == len(config["ports"]) else False
-	
-			# If broken, kill it
-			if not connectionActive:
-				logPrint("broken", "Unresponsive tunnel, killing it")
-				for pid in runningList:
-					shell(["kill", "-9", str(pid)])
-				runningList = []
-	
-		# If nothing is running
-		if len(runningList) == 0:
-			logPrint("bridge", "Creating bridge on port(s) %s" % (", ".join([str(port) for port in config["ports"]])))
-			try:
-				shell(command, noWait=True)
-			except Exception as e:
-				logPrint("error", "Failed while creating bridge with error: %s" % (str(e)))
-				
+
+		tunnelList = getTunnelList(config)
+
+		# The daemon owns the tunnels if running
+		daemonPid = readDaemonPid()
+		if args.daemon:
+			if daemonPid:
+				logPrint("error", "Daemon already running with pid %i" % (daemonPid))
+				sys.exit(1)
+			runDaemon(tunnelList, config["daemon"])
+			sys.exit(0)
+		if daemonPid:
+			sys.exit(0)
+
+		# Check the tunnels in parallel and restart the broken ones
+		with concurrent.futures.ThreadPoolExecutor(max_workers=len(tunnelList) or 1) as executor:
+			for future in [executor.submit(tunnel.ensure) for tunnel in tunnelList]:
+				future.result()
+
 	except Exception as e:
 		logPrint("error", "Unexpected error: %s" % (str(e)))
 		raise e
@@ -0,0 +1,416 @@
+#!/usr/bin/python3
+# -*- coding: iso-8859-15 -*-
+
+import os
+import sys
+import time
+import json
+import struct
+import random
+import shutil
+import mmap
+import hashlib
+import platform
+import tempfile
+import argparse
+import functools
+import subprocess
+import contextlib
+import resource
+from datetime import datetime
+
+import clean
+
+# Calls of clean.py counted during the phases, in addition to open, mmap and DirEntry.stat
+COUNTED_OS_CALLS = {"scandir", "stat", "lstat", "listdir", "rename", "replace", "remove", "unlink", "rmdir", "mkdir", "makedirs", "utime"}
+COUNTED_PATH_CALLS = {"exists", "isdir", "isfile", "islink", "ismount", "getmtime", "realpath"}
+
+"""
+Create an atom of a QuickTime/ISO-BMFF file
+"""
+def makeAtom(atomType, payload):
+	return struct.pack(">I4s", len(payload) + 8, atomType) + payload
+
+"""
+Create a minimal MOV file with a valid movie header, the media data is placed before
+the movie header like most encoders do when recording.
+"""
+def writeMovie(path, durationS, mediaSize=4096):
+	timescale = 600
+	mvhd = struct.pack(">B3xIIII", 0, 0, 0, timescale, int(durationS * timescale)) + b"\0" * 80
+	with open(path, "wb") as f:
+		f.write(makeAtom(b"ftyp", b"qt  \0\0\0\0qt  "))
+		f.write(makeAtom(b"mdat", b"\0" * mediaSize))
+		f.write(makeAtom(b"moov", makeAtom(b"mvhd", mvhd)))
+
+"""
+List the video files from the paths passed on the command line
+"""
+def listVideos(pathList):
+	fileList = []
+	for path in pathList:
+		if os.path.isdir(path):
+			for root, dirs, files in os.walk(path):
+				fileList += [os.path.join(root, file) for file in files if os.path.splitext(file)[1].lower() in (".mov", ".mp4")]
+		else:
+			fileList.append(path)
+	return sorted(fileList)
+
+"""
+Time a duration probe over all the files
+"""
+def benchmarkProbe(name, probe, fileList):
+	failures = 0
+	start = time.perf_counter()
+	for path in fileList:
+		try:
+			probe(path)
+		except Exception:
+			failures += 1
+	elapsed = time.perf_counter() - start
+	return {
+		"name": name,
+		"files": len(fileList),
+		"failures": failures,
+		"seconds": elapsed,
+		"msPerFile": (elapsed * 1000 / len(fileList)) if fileList else 0
+	}
+
+"""
+Generate a reproducible synthetic photo library of nbFiles media files, spread over
+directories nested depth levels deep, and return the number of files per kind.
+"""
+def generateLibrary(path, nbFiles, depth, filesPerDirectory, eaDirRatio, seed):
+
+	rand = random.Random(seed)
+	now = time.time()
+
+	# Number of sub-directories per level to get the expected number of leaf directories
+	nbDirectories = max(1, (nbFiles + filesPerDirectory - 1) // filesPerDirectory)
+	branching = max(1, int(round(nbDirectories ** (1.0 / depth)))) if depth > 0 else 1
+	while depth > 0 and branching ** depth < nbDirectories:
+		branching += 1
+
+	countList = {"photo": 0, "livePhoto": 0, "video": 0, "transcode": 0, "eaDir": 0}
+	index = 0
+	nbTotal = 0
+	for directoryIndex in range(nbDirectories):
+		parts = []
+		value = directoryIndex
+		for level in range(depth):
+			parts.append("d%i" % (value % branching))
+			value //= branching
+		directory = os.path.join(path, *reversed(parts))
+		os.makedirs(directory, exist_ok=True)
+
+		nbCreated = 0
+		while nbCreated < filesPerDirectory and nbTotal < nbFiles:
+			kind = rand.random()
+			name = "IMG_%06i" % (index)
+			createdList = []
+			# Still photos
+			if kind < 0.4:
+				createdList.append(name + rand.choice([".JPG", ".HEIC"]))
+				open(os.path.join(directory, createdList[-1]), "wb").close()
+				countList["photo"] += 1
+			# Live photos, some of them longer than the threshold, some edited
+			elif kind < 0.7:
+				imageName = (name.replace("IMG_", "IMG_E") if rand.random() < 0.1 else name) + rand.choice([".JPG", ".jpeg", ".HEIC"])
+				open(os.path.join(directory, imageName), "wb").close()
+				createdList += [imageName, name + rand.choice([".MOV", ".mov"])]
+				writeMovie(os.path.join(directory, createdList[-1]), rand.choice([1.5, 2.5, 3.2, 6]), mediaSize=256)
+				countList["livePhoto"] += 1
+			# Videos without photo
+			elif kind < 0.85:
+				createdList.append(name + ".MOV")
+				writeMovie(os.path.join(directory, createdList[-1]), 2, mediaSize=256)
+				countList["video"] += 1
+			# Transcoded videos, half of them old enough to be deleted
+			else:
+				createdList.append("VID_%06i (%s).mp4" % (index, rand.choice(["low", "medium", "high"])))
+				filePath = os.path.join(directory, createdList[-1])
+				open(filePath, "wb").close()
+				mtime = now - (60 * 60 * 24) * rand.choice([1, 10])
+				os.utime(filePath, (mtime, mtime))
+				countList["transcode"] += 1
+
+			# Thumbnails generated by DSM, not counted as media files
+			for createdName in createdList:
+				if rand.random() < eaDirRatio:
+					thumbnailDirectory = os.path.join(directory, "@eaDir", createdName)
+					os.makedirs(thumbnailDirectory, exist_ok=True)
+					open(os.path.join(thumbnailDirectory, "SYNOPHOTO_THUMB_M.jpg"), "wb").close()
+					countList["eaDir"] += 1
+
+			nbCreated += len(createdList)
+			nbTotal += len(createdList)
+			index += 1
+
+	return countList
+
+"""
+Proxy of a module counting the calls of some of its functions
+"""
+class CountingModule:
+	def __init__(self, module, nameSet, counter, prefix = ""):
+		self._module = module
+		self._nameSet = nameSet
+		self._counter = counter
+		self._prefix = prefix
+
+	def __getattr__(self, name):
+		value = getattr(self._module, name)
+		if name not in self._nameSet:
+			return value
+		return countCalls(value, self._counter, self._prefix + name)
+
+"""
+Wrap a function so that its calls are counted under a given key
+"""
+def countCalls(function, counter, key):
+	@functools.wraps(function)
+	def wrapper(*args, **kwargs):
+		counter[key] = counter.get(key, 0) + 1
+		result = function(*args, **kwargs)
+		# DirEntry cannot be patched, the entries are wrapped to count their stat calls
+		return CountingScandir(result, counter) if key == "scandir" else result
+	return wrapper
+
+"""
+Iterator of os.scandir returning entries which count their stat calls, cached by DirEntry or not
+"""
+class CountingScandir:
+	def __init__(self, iterator, counter):
+		self._iterator = iterator
+		self._counter = counter
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self._iterator.close()
+
+	def __iter__(self):
+		return (CountingDirEntry(entry, self._counter) for entry in self._iterator)
+
+class CountingDirEntry:
+	def __init__(self, entry, counter):
+		self._entry = entry
+		self.stat = countCalls(entry.stat, counter, "DirEntry.stat")
+
+	def __getattr__(self, name):
+		return getattr(self._entry, name)
+
+	def __fspath__(self):
+		return self._entry.path
+
+"""
+Read the number of read and write system calls of this process, if available
+"""
+def readProcessIO():
+	try:
+		with open("/proc/self/io", "r") as f:
+			return {key: int(value) for key, value in [line.split(":") for line in f if ":" in line]}
+	except OSError:
+		return {}
+
+"""
+Measure a phase: elapsed time, file system calls counted within clean.py (not system calls, a call may
+issue several or none if cached), read/write system calls and peak RSS
+"""
+@contextlib.contextmanager
+def measurePhase(resultList, name, counter):
+	counter.clear()
+	ioBefore = readProcessIO()
+	start = time.perf_counter()
+	result = {}
+	yield result
+	elapsed = time.perf_counter() - start
+	ioAfter = readProcessIO()
+	result.update({
+		"seconds": elapsed,
+		"osCalls": dict(sorted(counter.items())),
+		"readSyscalls": ioAfter.get("syscr", 0) - ioBefore.get("syscr", 0),
+		"writeSyscalls": ioAfter.get("syscw", 0) - ioBefore.get("syscw", 0),
+		# Peak since the start of the process, each size runs in its own process
+		"peakRssKb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	})
+	if result.get("files"):
+		result["filesPerSecond"] = result["files"] / max(elapsed, 1e-9)
+	resultList[name] = result
+
+"""
+Time separately the scan, probe, trash and trash expiry phases of clean.py over a library
+"""
+def benchmarkLibrary(path, trashPath, nbWorkers):
+
+	config = {
+		"path": path,
+		"deleteiOSLivePhoto": True,
+		"deleteTranscodedVideos": True,
+		"deleteExpirationDays": 2
+	}
+	trashConfig = {"trash": {"expirationDays": 7}}
+
+	clean.CURRENT_DIRECTORY_PATH = os.path.dirname(trashPath)
+	clean.PATH_TRASH = trashPath
+	clean.PATH_LOG = os.path.join(os.path.dirname(trashPath), "clean.log")
+	clean.trashRootByDevice.clear()
+
+	counter = {}
+	clean.os = CountingModule(os, COUNTED_OS_CALLS, counter)
+	clean.os.path = CountingModule(os.path, COUNTED_PATH_CALLS, counter, "path.")
+	clean.shutil = CountingModule(shutil, {"rmtree", "move"}, counter, "shutil.")
+	clean.mmap = CountingModule(mmap, {"mmap"}, counter, "mmap.")
+	# Shadows the builtin within clean.py
+	clean.open = countCalls(open, counter, "open")
+
+	phaseList = {}
+	videoList = []
+	transcodeList = []
+
+	# Matches the files against the rules without probing nor moving anything
+	def prepareScan(entry, config, directory):
+		if clean.prepareiOSLivePhoto(entry, config, directory) is not None:
+			videoList.append(entry.path)
+		return None
+	def collectTranscode(entry, config, probe):
+		if entry.stat().st_mtime < clean.now - (60 * 60 * 24) * config["deleteExpirationDays"]:
+			transcodeList.append(entry.path)
+		return False
+	scanRuleList = [
+		clean.Rule("deleteiOSLivePhoto", clean.RULES[0].regexpr.pattern, lambda entry, config, probe: False, prepareScan),
+		clean.Rule("deleteTranscodedVideos", clean.RULES[1].regexpr.pattern, collectTranscode)
+	]
+
+	try:
+		with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+
+			with measurePhase(phaseList, "scan", counter) as result:
+				clean.statistics.clear()
+				clean.searchDirectory(config, scanRuleList)
+				result["files"] = clean.statistics["fileScanned"]
+				result["directories"] = clean.statistics["directoryListed"]
+				result["pruned"] = clean.statistics["directoryPruned"]
+
+			with measurePhase(phaseList, "probe", counter) as result:
+				pipeline = clean.Pipeline(nbWorkers)
+				futureList = [pipeline.submit(functools.partial(clean.probeVideo, videoPath)) for videoPath in videoList]
+				trashList = [videoPath for videoPath, future in zip(videoList, futureList) if future.result().decision == "trash"]
+				pipeline.close()
+				result["files"] = len(videoList)
+
+			with measurePhase(phaseList, "trash", counter) as result:
+				for filePath in trashList + transcodeList:
+					clean.moveToTrash(filePath, config)
+				result["files"] = len(trashList) + len(transcodeList)
+
+			with measurePhase(phaseList, "expiry", counter) as result:
+				clean.now += (60 * 60 * 24) * (trashConfig["trash"]["expirationDays"] + 2)
+				clean.cleanupTrash(trashConfig)
+				result["files"] = len(trashList) + len(transcodeList)
+
+	finally:
+		clean.os = os
+		clean.shutil = shutil
+		clean.mmap = mmap
+		del clean.open
+
+	return phaseList
+
+"""
+Generate a library of a given size and benchmark it, meant to run in its own process
+"""
+def runLibrarySize(nbFiles, args):
+
+	with tempfile.TemporaryDirectory(dir=args.directory) as tempPath:
+		libraryPath = os.path.join(tempPath, "library")
+		start = time.perf_counter()
+		countList = generateLibrary(libraryPath, nbFiles, args.depth, args.files_per_directory, args.eadir_ratio, args.seed)
+		generateSeconds = time.perf_counter() - start
+		phaseList = benchmarkLibrary(libraryPath, os.path.join(tempPath, "trash"), args.workers)
+
+	return {
+		"files": nbFiles,
+		"generated": countList,
+		"generateSeconds": generateSeconds,
+		"phases": phaseList
+	}
+
+# Main
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description="Benchmarks of clean.py.")
+	subparsers = parser.add_subparsers(dest="command")
+	subparsers.required = True
+
+	parserProbe = subparsers.add_parser("probe", help="Compare the video duration probes.")
+	parserProbe.add_argument("path", nargs="*", help="Video files or directories to probe, synthetic videos are generated if omitted.")
+	parserProbe.add_argument("--count", type=int, default=200, help="Number of synthetic videos to generate.")
+	parserProbe.add_argument("--no-ffmpeg", action="store_true", help="Do not benchmark the ffmpeg probe.")
+
+	parserLibrary = subparsers.add_parser("library", help="Time the phases of clean.py over synthetic photo libraries.")
+	parserLibrary.add_argument("--sizes", default="10000,100000,1000000", help="Comma separated number of media files of the libraries.")
+	parserLibrary.add_argument("--depth", type=int, default=3, help="Depth of the directory tree.")
+	parserLibrary.add_argument("--files-per-directory", type=int, default=200, help="Number of media files per directory.")
+	parserLibrary.add_argument("--eadir-ratio", type=float, default=0.5, help="Ratio of files with a DSM thumbnail in @eaDir.")
+	parserLibrary.add_argument("--seed", type=int, default=0, help="Seed of the library generator.")
+	parserLibrary.add_argument("--workers", type=int, default=4, help="Number of probe workers.")
+	parserLibrary.add_argument("--directory", help="Directory where the libraries are generated, a temporary one by default.")
+	parserLibrary.add_argument("--output", help="Write the JSON results to this file instead of the standard output.")
+	parserLibrary.add_argument("--single", type=int, help=argparse.SUPPRESS)
+
+	args = parser.parse_args()
+
+	if args.command == "probe":
+		with tempfile.TemporaryDirectory() as tempPath:
+
+			fileList = listVideos(args.path)
+			if not fileList:
+				for index in range(args.count):
+					path = os.path.join(tempPath, "IMG_%04i.MOV" % (index))
+					writeMovie(path, 1 + (index % 5))
+					fileList.append(path)
+
+			resultList = [benchmarkProbe("header", clean.readMovieHeaderDuration, fileList)]
+			if not args.no_ffmpeg:
+				resultList.append(benchmarkProbe("ffmpeg", clean.videoDurationFFmpeg, fileList))
+
+		print(json.dumps(resultList, indent=4))
+
+	elif args.single is not None:
+		print(json.dumps(runLibrarySize(args.single, args)))
+
+	else:
+		# Each size runs in its own process so that the peak RSS is its own
+		sizeList = []
+		for nbFiles in [int(size) for size in args.sizes.split(",")]:
+			command = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ["--single", str(nbFiles)]
+			output = subprocess.check_output(command)
+			sizeList.append(json.loads(output))
+
+		with open(clean.__file__, "rb") as f:
+			cleanSha1 = hashlib.sha1(f.read()).hexdigest()
+
+		report = {
+			"date": str(datetime.now()),
+			"python": platform.python_version(),
+			"platform": platform.platform(),
+			"cleanSha1": cleanSha1,
+			"parameters": {
+				"depth": args.depth,
+				"filesPerDirectory": args.files_per_directory,
+				"eaDirRatio": args.eadir_ratio,
+				"seed": args.seed,
+				"workers": args.workers
+			},
+			"sizes": sizeList
+		}
+		reportString = json.dumps(report, indent=4)
+		if args.output:
+			with open(args.output, "w") as f:
+				f.write(reportString + "\n")
+		else:
+			print(reportString)
+
+	sys.exit(0)
@@ -1,13 +1,27 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 # -*- coding: iso-8859-15 -*-
 
 import os
 import sys
 import time
 import re
+import errno
 import subprocess
 import shutil
 import json
+import fnmatch
+import struct
+import hashlib
+import mmap
+import sqlite3
+import collections
+import argparse
+import functools
+import concurrent.futures
+import ctypes
+import ctypes.util
+import select
+import signal
 from datetime import datetime
 
 CURRENT_DIRECTORY_PATH = os.path.realpath(os.path.dirname(__file__))
@@ -15,12 +29,49 @@ CURRENT_DIRECTORY_PATH = os.path.realpath(os.path.dirname(__file__))
 PATH_LOG = os.path.join(CURRENT_DIRECTORY_PATH, "clean.log")
 PATH_CONFIG = os.path.join(CURRENT_DIRECTORY_PATH, ".clean.json")
 PATH_TRASH = os.path.join(CURRENT_DIRECTORY_PATH, "trash")
+PATH_CACHE = os.path.join(CURRENT_DIRECTORY_PATH, ".clean.db")
+
+# Trash created at the root of the volumes other than the one of this script
+TRASH_DIRECTORY_NAME = "@clean-trash"
+# Files moved to a trash bucket, with their original path
+TRASH_MANIFEST_NAME = ".manifest"
+# Format of the trash buckets, one per day
+TRASH_BUCKET_FORMAT = "%Y-%m-%d"
+
+# Size of the head and of the tail of the files hashed to discriminate the duplicate candidates
+DUPLICATE_PARTIAL_SIZE = 4096
+# Size of the memory mapped chunks when hashing a whole file
+DUPLICATE_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Synology system directories, never scanned
+DEFAULT_EXCLUDE_LIST = ["@eaDir", "@tmp", "@sharebin", "@Recycle", "@SynoResource", "@SynoDrive", "#recycle", "#snapshot", ".SynologyWorkingDirectory"]
 
 now = time.time()
 oldTime = now - (60 * 60 * 24) * 2 # 2 days ago
 
 atLeastOneAction = False
 
+# Counters reported at the end of the run
+statistics = collections.Counter()
+
+# Persistent cache of the probed videos, disabled if None
+probeCache = None
+
+# Persistent index of the scanned directories for incremental scans, disabled if None
+directoryIndex = None
+
+# Persistent cache of the file hashes, disabled if None
+hashCache = None
+
+# Watcher notified of every directory visited by the walk, disabled if None
+directoryWatcher = None
+
+# Trash directory by device
+trashRootByDevice = {}
+
+# Candidates of the duplicate detection by file size, as (path, stat, config)
+duplicateCandidates = {}
+
 def printAction(type, message):
 	print("%s\t%s" % (type, message))
 	with open(PATH_LOG, "a") as myfile:
@@ -28,89 +79,660 @@ def printAction(type, message):
 	atLeastOneAction = True
 
 """
-Search for pattern
+Print the counters of this run
+"""
+def printStatistics():
+	elapsed = max(time.time() - now, 0.001)
+	print("STATS\tthroughput: %i file(s) scanned, %i video(s) probed in %.1fs (%.1f files/s)" % (statistics["fileScanned"], statistics["videoProbed"], elapsed, statistics["fileScanned"] / elapsed))
+	print("STATS\tdirectories: %i listed, %i skipped" % (statistics["directoryListed"], statistics["directorySkipped"]))
+	print("STATS\tpruned: %i director(ies), %i file(s) excluded" % (statistics["directoryPruned"], statistics["fileExcluded"]))
+	print("STATS\tprobe cache: %i hit(s), %i miss(es), %i evicted" % (statistics["probeCacheHit"], statistics["probeCacheMiss"], statistics["probeCacheEvicted"]))
+	print("STATS\tduplicates: %i candidate(s), %i partial hash(es), %i full hash(es), %i duplicate(s)" % (statistics["duplicateCandidate"], statistics["duplicatePartialHash"], statistics["duplicateFullHash"], statistics["duplicateFound"]))
+	print("STATS\thash cache: %i hit(s), %i miss(es), %i evicted" % (statistics["hashCacheHit"], statistics["hashCacheMiss"], statistics["hashCacheEvicted"]))
+
+"""
+Persistent cache of values computed from files (probes, hashes...), keyed by (device, inode,
+size, mtime) so that unchanged files are never read twice. Entries of the files that
+disappeared from the directories listed since the last commit are evicted when committing.
+"""
+class FileCache:
+	def __init__(self, connection, name, columnList):
+		self.connection = connection
+		self.name = name
+		self.nbColumns = len(columnList)
+		self.connection.execute("CREATE TABLE IF NOT EXISTS %s (dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER, directory TEXT, %s, PRIMARY KEY (dev, ino))" % (name, ", ".join(columnList)))
+		self.connection.execute("CREATE INDEX IF NOT EXISTS %sDirectory ON %s (directory)" % (name, name))
+		self.seenSet = set()
+		self.directorySet = set()
+		self.nbPendingWrites = 0
+
+	"""
+	Record a directory that has been fully listed, stale entries are only evicted from those
+	"""
+	def addDirectory(self, directory):
+		self.directorySet.add(directory)
+
+	"""
+	Return the tuple of values cached for this file or None
+	"""
+	def get(self, stat):
+		key = (stat.st_dev, stat.st_ino)
+		self.seenSet.add(key)
+		row = self.connection.execute("SELECT * FROM %s WHERE dev = ? AND ino = ?" % (self.name), key).fetchone()
+		if row is not None and row[2] == stat.st_size and row[3] == stat.st_mtime_ns:
+			statistics[self.name + "CacheHit"] += 1
+			return row[5:]
+		statistics[self.name + "CacheMiss"] += 1
+		return None
+
+	def set(self, stat, directory, *valueList):
+		key = (stat.st_dev, stat.st_ino)
+		self.seenSet.add(key)
+		self.connection.execute("INSERT OR REPLACE INTO %s VALUES (%s)" % (self.name, ", ".join(["?"] * (5 + self.nbColumns))), key + (stat.st_size, stat.st_mtime_ns, directory) + valueList)
+		self.nbPendingWrites += 1
+		if self.nbPendingWrites >= 1000:
+			self.connection.commit()
+			self.nbPendingWrites = 0
+
+	def commit(self):
+		# Only the rows of the listed directories are read, through the directory index
+		staleList = []
+		for directory in self.directorySet:
+			staleList += [(dev, ino) for dev, ino in self.connection.execute("SELECT dev, ino FROM %s WHERE directory = ?" % (self.name), (directory,))
+					if (dev, ino) not in self.seenSet]
+		self.connection.executemany("DELETE FROM %s WHERE dev = ? AND ino = ?" % (self.name), staleList)
+		statistics[self.name + "CacheEvicted"] += len(staleList)
+		self.connection.commit()
+		self.seenSet.clear()
+		self.directorySet.clear()
+		self.nbPendingWrites = 0
+
+	"""
+	Forget the directories listed since the last commit without evicting anything, for a pass which did not look up all their files
+	"""
+	def reset(self):
+		self.seenSet.clear()
+		self.directorySet.clear()
+
+"""
+Persistent index of the scanned directories, used to skip listing the directories that
+did not change since the last run. A directory is listed again if its mtime changed or
+if one of its files has a pending time based decision that is now due.
+Its sub-directories are still visited, through the list recorded in the index.
+"""
+class DirectoryIndex:
+	def __init__(self, connection, fingerprint, fullScanDays, forceFullScan = False):
+		self.connection = connection
+		self.connection.execute("CREATE TABLE IF NOT EXISTS directory (path TEXT PRIMARY KEY, mtime INTEGER, nextCheck REAL, children TEXT)")
+		self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+		self.fingerprint = fingerprint
+		self.visitedSet = set()
+		self.pending = {}
+
+		# A full scan is needed if forced, if the configuration changed or if the last one is too old
+		lastFullScan = self.getMeta("lastFullScan")
+		self.isFullScan = forceFullScan \
+				or self.getMeta("fingerprint") != fingerprint \
+				or lastFullScan is None \
+				or float(lastFullScan) < now - (60 * 60 * 24) * fullScanDays
+
+	def getMeta(self, key):
+		row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key, )).fetchone()
+		return row[0] if row else None
+
+	def setMeta(self, key, value):
+		self.connection.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, str(value)))
+
+	"""
+	Return the list of sub-directories if the directory does not need to be listed, None otherwise
+	"""
+	def getUnchangedChildren(self, directory, stat):
+		self.visitedSet.add(directory)
+		if self.isFullScan:
+			return None
+		row = self.connection.execute("SELECT mtime, nextCheck, children FROM directory WHERE path = ?", (directory, )).fetchone()
+		if row is None or row[0] != stat.st_mtime_ns or (row[1] is not None and row[1] <= now):
+			return None
+		return json.loads(row[2])
+
+	"""
+	Record that a file of this directory will need to be checked again at a given time
+	"""
+	def addPendingDecision(self, directory, timestamp):
+		self.pending[directory] = min(timestamp, self.pending.get(directory, timestamp))
+
+	def update(self, directory, stat, children):
+		self.visitedSet.add(directory)
+		nextCheck = self.pending.pop(directory, None)
+		# The mtime of a directory modified while being listed cannot be trusted, check it again next run
+		if stat.st_mtime >= now - 2:
+			nextCheck = now
+		self.connection.execute("INSERT OR REPLACE INTO directory VALUES (?, ?, ?, ?)", (directory, stat.st_mtime_ns, nextCheck, json.dumps(children)))
+
+	def close(self):
+		if self.isFullScan:
+			staleList = [(path, ) for path, in self.connection.execute("SELECT path FROM directory") if path not in self.visitedSet]
+			self.connection.executemany("DELETE FROM directory WHERE path = ?", staleList)
+			self.setMeta("lastFullScan", now)
+			self.setMeta("fingerprint", self.fingerprint)
+		self.connection.commit()
+
+"""
+A cleanup rule, dispatching the files which name matches a pattern to a handler.
+The optional prepare function runs first with the directory listing, it must not have side effects and returns
+either a value or a probe to be run by the worker pool. The handler is then called in
+order with this value or the probe result, and returns True if it moved the file, in
+which case the next rules are skipped.
+"""
+class Rule:
+	def __init__(self, name, regexpr, callback, prepare = None, needsFullListing = False):
+		self.name = name
+		self.regexpr = re.compile(regexpr)
+		self.callback = callback
+		self.prepare = prepare
+		# The rule needs to see all the files, incremental scans cannot skip directories
+		self.needsFullListing = needsFullListing
+
+	def isEnabled(self, config):
+		return self.name in config and bool(config[self.name])
+
+	def match(self, entry):
+		return self.regexpr.match(entry.name) is not None
+
+"""
+Match the name or the path relative to the scanned directory of an entry against a list of globs
+"""
+class PathFilter:
+	def __init__(self, globList):
+		self.regexpr = re.compile("|".join([fnmatch.translate(glob) for glob in globList])) if globList else None
+
+	def match(self, name, relativePath):
+		if self.regexpr is None:
+			return False
+		return self.regexpr.match(name) is not None or self.regexpr.match(relativePath) is not None
+
+"""
+Listing of a directory, shared by the rules while its files are dispatched
+"""
+class Directory:
+	def __init__(self, path, entryList):
+		self.path = path
+		self.entryList = entryList
+		self._extensionIndex = None
+
+	"""
+	Lower case extensions of the files in this directory, by lower case name without extension
+	"""
+	@property
+	def extensionIndex(self):
+		if self._extensionIndex is None:
+			self._extensionIndex = {}
+			for entry in self.entryList:
+				if not entry.is_dir():
+					name, extension = os.path.splitext(entry.name.lower())
+					self._extensionIndex.setdefault(name, set()).add(extension)
+		return self._extensionIndex
+
+	"""
+	Check if a file with this name (without extension) and one of the extensions exists, case insensitive
+	"""
+	def hasFile(self, name, extensionSet):
+		return not extensionSet.isdisjoint(self.extensionIndex.get(name.lower(), ()))
+
+"""
+Run the probes in a bounded pool of workers, overlapping with the directory walk, while
+the callbacks are called in submission order so trash moves and logs stay deterministic.
+"""
+class Pipeline:
+	def __init__(self, nbWorkers):
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=nbWorkers) if nbWorkers > 1 else None
+		self.maxPending = max(nbWorkers, 1) * 8
+		self.queue = collections.deque()
+
+	"""
+	Run a probe, in the worker pool if any, and return its future
+	"""
+	def submit(self, probe):
+		if self.executor:
+			return self.executor.submit(probe)
+		# Errors are kept in the future, as in the worker pool
+		future = concurrent.futures.Future()
+		try:
+			future.set_result(probe())
+		except Exception as e:
+			future.set_exception(e)
+		return future
+
+	"""
+	Queue a callback, futures passed as arguments are replaced by their result
+	"""
+	def push(self, callback, *argList):
+		self.queue.append((callback, argList))
+		self.process()
+
+	"""
+	Call the queued callbacks which arguments are ready, wait if too many are pending
+	"""
+	def process(self, wait = False):
+		while self.queue:
+			callback, argList = self.queue[0]
+			if not wait and len(self.queue) <= self.maxPending:
+				if any(not arg.done() for arg in argList if isinstance(arg, concurrent.futures.Future)):
+					break
+			self.queue.popleft()
+			callback(*[arg.result() if isinstance(arg, concurrent.futures.Future) else arg for arg in argList])
+
+	def flush(self):
+		self.process(wait = True)
+
+	"""
+	Drop the queued callbacks, after a walk was interrupted by an error
+	"""
+	def clear(self):
+		self.queue.clear()
+
+	def close(self):
+		if self.executor:
+			self.executor.shutdown()
+
+# Pool probing the files, synchronous by default
+pipeline = Pipeline(1)
+
+"""
+Call the handlers of the rules matching a file, until one of them moves it.
+A file that cannot be handled (removed meanwhile, trash not writable) is skipped.
 """
-def searchDirectory(config, regexpr, callback):
+def applyRules(entry, config, ruleList, *resultList):
+	for rule, result in zip(ruleList, resultList):
+		try:
+			if rule.callback(entry, config, result):
+				break
+		except OSError as e:
+			printAction("ERROR", "Cannot handle %s with rule %s: %s" % (entry.path, rule.name, str(e)))
+			break
+
+"""
+Called once all the files of a directory have been handled
+"""
+def completeDirectory(directory, stat, children):
+	if probeCache:
+		probeCache.addDirectory(directory)
+	if hashCache:
+		hashCache.addDirectory(directory)
+	if directoryIndex:
+		directoryIndex.update(directory, stat, children)
+
+"""
+Walk the directory once and dispatch each file to all the matching rules.
+Only a sub-directory can be walked, optionally not recursively and without skipping the
+directories that are unchanged according to the index.
+"""
+def searchDirectory(config, ruleList, directory = None, recursive = True, useIndex = True):
 
 	if not config["path"]:
 		return
 
-	r = re.compile(regexpr)
+	ruleList = [rule for rule in ruleList if rule.isEnabled(config)]
+	if not ruleList:
+		return
 
-	for root, dirs, files in os.walk(str(config["path"])):
-		for file in files:
-			if r.match(file):
-				callback(os.path.join(root, file), config)
+	# Excluded directories are pruned before being listed, included globs only apply to files
+	rootPath = os.path.normpath(str(config["path"]))
+	rootPrefixLength = len(os.path.join(rootPath, ""))
+	excludeFilter = PathFilter(DEFAULT_EXCLUDE_LIST + config.get("exclude", []))
+	includeFilter = PathFilter(config.get("include", []))
+	maxDepth = config.get("maxDepth")
+	isIncremental = useIndex and not any(rule.needsFullListing for rule in ruleList)
+
+	# Starting from a sub-directory, which might have been excluded
+	startPath = os.path.normpath(directory) if directory else rootPath
+	startDepth = 0
+	if startPath != rootPath:
+		relativePath = startPath[rootPrefixLength:]
+		if not startPath.startswith(os.path.join(rootPath, "")) or not os.path.isdir(startPath) or os.path.islink(startPath) \
+				or os.path.basename(startPath) == TRASH_DIRECTORY_NAME or startPath == PATH_TRASH \
+				or excludeFilter.match(os.path.basename(startPath), relativePath):
+			return
+		startDepth = relativePath.count(os.sep) + 1
+		if maxDepth is not None and startDepth > maxDepth:
+			return
+
+	stack = [(startPath, None, startDepth)]
+	while stack:
+		directory, stat, depth = stack.pop()
+		if directoryWatcher:
+			directoryWatcher.addWatch(directory, config)
+		try:
+			if directoryIndex:
+				stat = stat or os.stat(directory)
+				children = directoryIndex.getUnchangedChildren(directory, stat) if isIncremental else None
+				if children is not None:
+					statistics["directorySkipped"] += 1
+					stack.extend(reversed([(child, None, depth + 1) for child in children]))
+					continue
+			with os.scandir(directory) as it:
+				entryList = sorted(it, key=lambda entry: entry.name)
+		except OSError as e:
+			print("WARNING cannot list directory %s: %s" % (directory, str(e)))
+			continue
+		statistics["directoryListed"] += 1
+
+		subDirectoryList = []
+		current = Directory(directory, entryList)
+		for entry in entryList:
+			relativePath = entry.path[rootPrefixLength:]
+			# Same as os.walk, symbolic links to directories are not followed
+			if entry.is_dir():
+				if entry.is_symlink() or isTrash(entry):
+					continue
+				if excludeFilter.match(entry.name, relativePath) or (maxDepth is not None and depth >= maxDepth):
+					statistics["directoryPruned"] += 1
+					continue
+				subDirectoryList.append((entry.path, entry.stat(follow_symlinks=False) if directoryIndex else None, depth + 1))
+				continue
+			if excludeFilter.match(entry.name, relativePath) or (includeFilter.regexpr and not includeFilter.match(entry.name, relativePath)):
+				statistics["fileExcluded"] += 1
+				continue
+			statistics["fileScanned"] += 1
+			matchList = [rule for rule in ruleList if rule.match(entry)]
+			if matchList:
+				resultList = []
+				for rule in matchList:
+					result = rule.prepare(entry, config, current) if rule.prepare else None
+					resultList.append(pipeline.submit(result) if callable(result) else result)
+				pipeline.push(applyRules, entry, config, matchList, *resultList)
+		pipeline.push(completeDirectory, directory, stat, [path for path, subStat, subDepth in subDirectoryList])
 
+		# Reversed so that sub-directories are processed in alphabetical order
+		if recursive:
+			stack.extend(reversed(subDirectoryList))
+
+	pipeline.flush()
+
+"""
+Find the mount point of a path
+"""
+def findMountPoint(path):
+	path = os.path.realpath(path)
+	while not os.path.ismount(path):
+		path = os.path.dirname(path)
+	return path
+
+"""
+Get the trash directory of a device, files are always renamed within the same volume
 """
-Search for pattern
+def getTrashRoot(path, device):
+	if device not in trashRootByDevice:
+		if os.stat(CURRENT_DIRECTORY_PATH).st_dev == device:
+			trashRootByDevice[device] = PATH_TRASH
+		else:
+			trashRootByDevice[device] = os.path.join(findMountPoint(path), TRASH_DIRECTORY_NAME)
+	return trashRootByDevice[device]
+
+"""
+Check if a directory entry is a trash, so it is never scanned
+"""
+def isTrash(entry):
+	return entry.name == TRASH_DIRECTORY_NAME or entry.path == PATH_TRASH
+
+"""
+Get the date of a trash bucket from its name, or None if not a bucket
+"""
+def getTrashBucketDate(name):
+	try:
+		return datetime.strptime(name, TRASH_BUCKET_FORMAT)
+	except ValueError:
+		return None
+
+"""
+Read the manifest of a trash bucket
+"""
+def readTrashManifest(bucket):
+	path = os.path.join(bucket, TRASH_MANIFEST_NAME)
+	if not os.path.exists(path):
+		return []
+	with open(path, "r") as f:
+		return [json.loads(line) for line in f if line.strip()]
+
+"""
+Delete the expired buckets of the trash, without looking at the files they contain
 """
 def cleanupTrash(config):
 
-	for root, dirs, files in os.walk(PATH_TRASH):
+	expiration = datetime.fromtimestamp(now - (60 * 60 * 24) * config["trash"]["expirationDays"])
+	trashRootSet = set(trashRootByDevice.values())
+	trashRootSet.add(PATH_TRASH)
+
+	for trashRoot in sorted(trashRootSet):
+		if not os.path.isdir(trashRoot):
+			continue
+		with os.scandir(trashRoot) as it:
+			entryList = sorted(it, key=lambda entry: entry.name)
+		for entry in entryList:
+			date = getTrashBucketDate(entry.name)
+			if date is None:
+				# Files trashed before the buckets were introduced
+				if trashRoot == PATH_TRASH:
+					cleanupLegacyTrash(entry.path, config)
+			elif date.replace(hour=23, minute=59, second=59) < expiration:
+				nbFiles = len(readTrashManifest(entry.path))
+				shutil.rmtree(entry.path)
+				printAction("DELETE", "%s (%i file(s))" % (entry.path, nbFiles))
+
+"""
+Delete the expired files of the trash directories which are not buckets, based on their mtime
+"""
+def cleanupLegacyTrash(path, config):
+
+	expiration = now - (60 * 60 * 24) * config["trash"]["expirationDays"]
+
+	if not os.path.isdir(path):
+		if os.path.getmtime(path) < expiration:
+			os.remove(path)
+			printAction("DELETE", path)
+		return
+
+	for root, dirs, files in os.walk(path, topdown=False):
 		for file in files:
-			path = os.path.join(root, file)
-			mtime = os.path.getmtime(path)
-			if mtime < (now - (60 * 60 * 24) * config["trash"]["expirationDays"]):
-				os.remove(path)
-				printAction("DELETE", path)
+			filePath = os.path.join(root, file)
+			if os.path.getmtime(filePath) < expiration:
+				os.remove(filePath)
+				printAction("DELETE", filePath)
+		if not os.listdir(root):
+			os.rmdir(root)
 
 """
-Move a file to trash
+Move a file to trash, in the bucket of the day on the same volume
 """
-def moveToTrash(path, config):
-	destination = PATH_TRASH + path
+def moveToTrash(path, config, stat = None):
+	stat = stat or os.lstat(path)
+	bucket = os.path.join(getTrashRoot(path, stat.st_dev), datetime.fromtimestamp(now).strftime(TRASH_BUCKET_FORMAT))
+	destination = bucket + path
 
 	# Destination directory
 	destinationDir = os.path.dirname(destination)
 	if not os.path.exists(destinationDir):
 		os.makedirs(destinationDir)
 
-	# Move and touch the file to update its modification time
-	shutil.move(path, destination)
-	with open(destination, 'ab'):
-		os.utime(destination, None)
+	try:
+		os.rename(path, destination)
+	# The file is on another filesystem mounted within the same device (bind mounts)
+	except OSError as e:
+		if e.errno != errno.EXDEV:
+			raise
+		shutil.move(path, destination)
+
+	with open(os.path.join(bucket, TRASH_MANIFEST_NAME), "a") as f:
+		f.write(json.dumps({"source": path, "destination": destination, "time": now}) + "\n")
 
 	printAction("TRASH", "%s -> %s" % (path, destination))
 
+"""
+Restore the files moved to trash on a given day, optionally only the ones within a path
+"""
+def restoreTrash(config, date, prefix = None):
+
+	trashRootSet = set(trashRootByDevice.values())
+	trashRootSet.add(PATH_TRASH)
+
+	for trashRoot in sorted(trashRootSet):
+		bucket = os.path.join(trashRoot, date)
+		remainingList = []
+		for item in readTrashManifest(bucket):
+			if (prefix and not item["source"].startswith(prefix)) or os.path.exists(item["source"]) or not os.path.exists(item["destination"]):
+				remainingList.append(item)
+				continue
+			sourceDir = os.path.dirname(item["source"])
+			if not os.path.exists(sourceDir):
+				os.makedirs(sourceDir)
+			os.rename(item["destination"], item["source"])
+			printAction("RESTORE", "%s -> %s" % (item["destination"], item["source"]))
+
+		if os.path.isdir(bucket):
+			manifestPath = os.path.join(bucket, TRASH_MANIFEST_NAME)
+			with open(manifestPath + ".tmp", "w") as f:
+				f.writelines([json.dumps(item) + "\n" for item in remainingList])
+			os.replace(manifestPath + ".tmp", manifestPath)
+
 """
 Move a file to trash only if old
 """
-def moveToTrashIfOld(path, config):
-	mtime = os.path.getmtime(path)
+def moveToTrashIfOld(entry, config, probe = None):
+	mtime = entry.stat().st_mtime
 
 	if "deleteExpirationDays" not in config or mtime < (now - (60 * 60 * 24) * config["deleteExpirationDays"]):
-		moveToTrash(path, config)
+		moveToTrash(entry.path, config, entry.stat())
+		return True
+
+	# The directory must be listed again once the file expires
+	if directoryIndex:
+		directoryIndex.addPendingDecision(os.path.dirname(entry.path), mtime + (60 * 60 * 24) * config["deleteExpirationDays"])
+	return False
+
+# Result of a video probe
+Probe = collections.namedtuple("Probe", ["duration", "decision", "isCached"])
+
+# Extensions of the still image of a live photo
+LIVE_PHOTO_IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".heic"}
 
 """
-Check if it is a live photo and move it to trash
+Check if it is a live photo and return the cached probe of its video, or the probe to run.
+The image is looked up in the directory listing, also matching the edited variants (IMG_E1234).
 """
-def handleiOSLivePhoto(path, config):
+def prepareiOSLivePhoto(entry, config, directory):
 
-	correspondingImg1 = path.replace('.MOV', '.JPG')
-	correspondingImg2 = path.replace('.MOV', '.HEIC')
-	if os.path.isfile(correspondingImg1) or os.path.isfile(correspondingImg2):
+	name = os.path.splitext(entry.name)[0]
+	nameList = [name]
+	match = re.match(r'^(IMG_)(E?)(\d.*)$', name, re.IGNORECASE)
+	if match:
+		nameList.append(match.group(1) + ("" if match.group(2) else "E") + match.group(3))
+	if not any(directory.hasFile(candidate, LIVE_PHOTO_IMAGE_EXTENSIONS) for candidate in nameList):
+		return None
 
-		try:
-			t = videoDuration(path)
-			# Shorter than 4 seconds
-			# There are some iOS Live Photo that are >3 seconds.
-			if t < 4:
-				moveToTrash(path, config)
-		except:
-			print("WARNING cannot read video duration of %s" % (path))
+	cached = probeCache.get(entry.stat()) if probeCache else None
+	if cached is not None:
+		return Probe(cached[0], cached[1], True)
+	return functools.partial(probeVideo, entry.path)
 
 """
-Get the video duration
+Read the duration of a video and decide what to do with it, runs in the worker pool
 """
-def videoDuration(path):
+def probeVideo(path):
+	try:
+		duration = videoDuration(path)
+	except:
+		return Probe(None, "error", False)
+	# Shorter than 4 seconds
+	# There are some iOS Live Photo that are >3 seconds.
+	return Probe(duration, "trash" if duration < 4 else "keep", False)
+
+"""
+Move the video of a live photo to trash
+"""
+def handleiOSLivePhoto(entry, config, probe):
+
+	if probe is None:
+		return False
+
+	if not probe.isCached:
+		statistics["videoProbed"] += 1
+		if probeCache:
+			probeCache.set(entry.stat(), os.path.dirname(entry.path), probe.duration, probe.decision)
+
+	if probe.decision == "error":
+		print("WARNING cannot read video duration of %s" % (entry.path))
+	elif probe.decision == "trash":
+		moveToTrash(entry.path, config, entry.stat())
+		return True
+	return False
+
+"""
+Find an atom of a QuickTime/ISO-BMFF file within [start, end[ and return its payload boundaries
+"""
+def findAtom(f, atomType, start, end):
+
+	offset = start
+	while offset + 8 <= end:
+		f.seek(offset)
+		size, currentType = struct.unpack(">I4s", f.read(8))
+		headerSize = 8
+		# 64-bit atom size
+		if size == 1:
+			size, = struct.unpack(">Q", f.read(8))
+			headerSize = 16
+		# Atom extends to the end of its container
+		elif size == 0:
+			size = end - offset
+		if size < headerSize or offset + size > end:
+			raise Exception("Invalid atom '%s' at offset %i" % (currentType.decode("latin-1"), offset))
+		if currentType == atomType:
+			return offset + headerSize, offset + size
+		offset += size
+
+	raise Exception("Atom '%s' not found" % (atomType.decode("latin-1")))
+
+"""
+Read the video duration from the movie header (moov/mvhd atom) of a MOV/MP4 file
+"""
+def readMovieHeaderDuration(path):
+
+	with open(path, "rb") as f:
+		fileSize = f.seek(0, os.SEEK_END)
+		moovStart, moovEnd = findAtom(f, b"moov", 0, fileSize)
+		mvhdStart, mvhdEnd = findAtom(f, b"mvhd", moovStart, moovEnd)
+		f.seek(mvhdStart)
+		data = f.read(min(32, mvhdEnd - mvhdStart))
+
+	if len(data) < 20:
+		raise Exception("Truncated movie header in %s" % (path))
+
+	# Version 1 uses 64-bit creation/modification times and duration
+	if data[0] == 1:
+		if len(data) < 32:
+			raise Exception("Truncated movie header in %s" % (path))
+		timescale, duration = struct.unpack(">IQ", data[20:32])
+		unknownDuration = 0xffffffffffffffff
+	else:
+		timescale, duration = struct.unpack(">II", data[12:20])
+		unknownDuration = 0xffffffff
+
+	# Fragmented files store 0, the real duration lives in the fragments.
+	if timescale == 0 or duration in (0, unknownDuration):
+		raise Exception("Unknown duration in movie header of %s" % (path))
+
+	return float(duration) / timescale
+
+"""
+Get the video duration by decoding it with ffmpeg, slow but works with any format
+"""
+def videoDurationFFmpeg(path):
 
 	proc = subprocess.Popen(["ffmpeg", "-i", path, "-f", "null"], stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
 	stdout, stderr = proc.communicate()
 
 	# Find the duration of the first channel
-	regexpr = re.compile('Duration:\s*([^\s]+),')
-	match = regexpr.findall(stdout + stderr)
+	regexpr = re.compile(r'Duration:\s*([^\s]+),')
+	match = regexpr.findall((stdout + stderr).decode(errors="replace"))
 	if not match:
 		raise Exception("Unable to read video duration of %s" % (path))
 
@@ -118,6 +740,307 @@ def videoDuration(path):
 	t = datetime.strptime(match[0], '%H:%M:%S.%f')
 	return (t - datetime(1900,1,1)).total_seconds()
 
+"""
+Get the video duration, ffmpeg is only used for the files which header cannot be parsed
+"""
+def videoDuration(path):
+
+	try:
+		return readMovieHeaderDuration(path)
+	except Exception:
+		return videoDurationFFmpeg(path)
+
+"""
+Collect the files for the duplicate detection, which happens once all directories are scanned
+"""
+def collectDuplicateCandidate(entry, config, probe = None):
+	stat = entry.stat()
+	if stat.st_size > 0:
+		duplicateCandidates.setdefault(stat.st_size, []).append((entry.path, stat, config))
+		statistics["duplicateCandidate"] += 1
+	return False
+
+"""
+Hash the head and the tail of a file
+"""
+def hashFilePartial(path, size):
+	h = hashlib.blake2b(digest_size=16)
+	with open(path, "rb") as f:
+		h.update(f.read(DUPLICATE_PARTIAL_SIZE))
+		if size > DUPLICATE_PARTIAL_SIZE:
+			f.seek(max(size - DUPLICATE_PARTIAL_SIZE, DUPLICATE_PARTIAL_SIZE))
+			h.update(f.read(DUPLICATE_PARTIAL_SIZE))
+	return h.digest()
+
+"""
+Hash the whole content of a file, memory mapping it chunk by chunk. The file must still have the size it was grouped by.
+"""
+def hashFileFull(path, size):
+	h = hashlib.blake2b(digest_size=32)
+	with open(path, "rb") as f:
+		if os.fstat(f.fileno()).st_size != size:
+			raise OSError("size changed since the scan")
+		for offset in range(0, size, DUPLICATE_CHUNK_SIZE):
+			with mmap.mmap(f.fileno(), min(DUPLICATE_CHUNK_SIZE, size - offset), access=mmap.ACCESS_READ, offset=offset) as chunk:
+				h.update(chunk)
+	return h.digest()
+
+"""
+Split the groups of duplicate candidates by partial or full hash, and keep the ones with
+more than one file. Hashes are computed in the worker pool unless cached.
+"""
+def splitDuplicateGroups(groupList, hashesByFile, isFull):
+
+	# The partial hash already covers the whole content of small files
+	index = 1 if isFull else 0
+	pendingList = []
+	for group in groupList:
+		for path, stat, config in group:
+			hashes = hashesByFile[(stat.st_dev, stat.st_ino)]
+			if isFull and stat.st_size <= 2 * DUPLICATE_PARTIAL_SIZE:
+				hashes[1] = hashes[0]
+			if hashes[index] is None:
+				statistics["duplicateFullHash" if isFull else "duplicatePartialHash"] += 1
+				hashFunction = hashFileFull if isFull else hashFilePartial
+				pendingList.append((path, stat, pipeline.submit(functools.partial(hashFunction, path, stat.st_size))))
+
+	for path, stat, future in pendingList:
+		hashes = hashesByFile[(stat.st_dev, stat.st_ino)]
+		try:
+			hashes[index] = future.result()
+		# ValueError if the file shrank while being memory mapped
+		except (OSError, ValueError) as e:
+			print("WARNING cannot hash %s: %s" % (path, str(e)))
+			continue
+		if hashCache:
+			hashCache.set(stat, os.path.dirname(path), hashes[0], hashes[1])
+
+	resultList = []
+	for group in groupList:
+		groupByHash = {}
+		for candidate in group:
+			digest = hashesByFile[(candidate[1].st_dev, candidate[1].st_ino)][index]
+			if digest is not None:
+				groupByHash.setdefault(digest, []).append(candidate)
+		resultList += [subGroup for digest, subGroup in sorted(groupByHash.items()) if len(subGroup) > 1]
+	return resultList
+
+"""
+Find the byte identical files among the candidates and move all but the oldest one to trash.
+Files are first grouped by size, then by hash of their head and tail, and only then by hash of
+their whole content.
+"""
+def deleteDuplicates():
+
+	groupList = []
+	hashesByFile = {}
+	for size, candidateList in sorted(duplicateCandidates.items()):
+		# Hard links of the same file are not duplicates
+		candidateByFile = {}
+		for candidate in candidateList:
+			candidateByFile.setdefault((candidate[1].st_dev, candidate[1].st_ino), candidate)
+		if len(candidateByFile) < 2:
+			continue
+		for key, (path, stat, config) in candidateByFile.items():
+			cached = hashCache.get(stat) if hashCache else None
+			hashesByFile[key] = list(cached) if cached else [None, None]
+		groupList.append(sorted(candidateByFile.values(), key=lambda candidate: candidate[0]))
+	duplicateCandidates.clear()
+
+	groupList = splitDuplicateGroups(groupList, hashesByFile, isFull=False)
+	groupList = splitDuplicateGroups(groupList, hashesByFile, isFull=True)
+
+	for group in groupList:
+		group.sort(key=lambda candidate: (candidate[1].st_mtime, len(candidate[0]), candidate[0]))
+		original = group[0][0]
+		for path, stat, config in group[1:]:
+			statistics["duplicateFound"] += 1
+			printAction("DUPLICATE", "%s = %s" % (path, original))
+			try:
+				moveToTrash(path, config, stat)
+			except OSError as e:
+				printAction("ERROR", "Cannot move %s to trash: %s" % (path, str(e)))
+
+"""
+Cleanup rules, each file is checked against all of them in this order during a single walk
+"""
+RULES = [
+	# Handle iOS live photos and delete them
+	Rule("deleteiOSLivePhoto", r'(?i).*\.mov$', handleiOSLivePhoto, prepareiOSLivePhoto),
+	# Cleanup transcoded videos
+	Rule("deleteTranscodedVideos", r'.*\((low|medium|high)\).*', moveToTrashIfOld),
+	# Collect the photos and videos for the duplicate detection
+	Rule("deleteDuplicates", r'(?i).*\.(jpe?g|heic|heif|png|gif|tiff?|dng|cr2|nef|arw|mov|mp4|m4v|avi|3gp|mkv)$', collectDuplicateCandidate, needsFullListing = True)
+]
+
+"""
+Minimal inotify binding through ctypes (Linux only), watching the directories visited by the walk
+"""
+class Inotify:
+	IN_CLOSE_WRITE = 0x00000008
+	IN_MOVED_TO = 0x00000080
+	IN_CREATE = 0x00000100
+	IN_DELETE_SELF = 0x00000400
+	IN_MOVE_SELF = 0x00000800
+	IN_Q_OVERFLOW = 0x00004000
+	IN_IGNORED = 0x00008000
+	IN_ISDIR = 0x40000000
+	IN_CLOEXEC = 0o2000000
+
+	# Files written or moved in, directories created or moved in
+	WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+
+	def __init__(self):
+		self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+		self.fd = self.libc.inotify_init1(Inotify.IN_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), "inotify_init1 failed: %s" % (os.strerror(ctypes.get_errno())))
+		# Watched directory and its configuration by watch descriptor
+		self.watchList = {}
+		self.isLimitReached = False
+
+	def addWatch(self, directory, config):
+		wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), Inotify.WATCH_MASK)
+		if wd < 0:
+			# Directories that cannot be watched are only handled by the reconcile passes
+			if not self.isLimitReached:
+				print("WARNING cannot watch %s (consider increasing fs.inotify.max_user_watches): %s" % (directory, os.strerror(ctypes.get_errno())))
+				self.isLimitReached = True
+			return
+		self.watchList[wd] = (directory, config)
+
+	"""
+	Wait for events and return them as a list of (directory, name, mask, config), the
+	directory is None if events were lost.
+	"""
+	def read(self, timeout):
+		if not select.select([self.fd], [], [], timeout)[0]:
+			return []
+		data = os.read(self.fd, 256 * 1024)
+		eventList = []
+		offset = 0
+		while offset + 16 <= len(data):
+			wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+			name = os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b"\0"))
+			offset += 16 + length
+			if mask & Inotify.IN_Q_OVERFLOW:
+				eventList.append((None, None, mask, None))
+			elif mask & Inotify.IN_IGNORED:
+				self.watchList.pop(wd, None)
+			elif wd in self.watchList:
+				directory, config = self.watchList[wd]
+				eventList.append((directory, name, mask, config))
+		return eventList
+
+	def close(self):
+		os.close(self.fd)
+
+"""
+Scan all the directories of the configuration, then look for duplicates among them
+"""
+def scanAll(config, database, forceFullScan = False):
+	global directoryIndex
+
+	if config["incremental"].get("enabled", True):
+		fingerprint = json.dumps(config["directoryList"], sort_keys=True)
+		directoryIndex = DirectoryIndex(database, fingerprint, config["incremental"].get("fullScanDays", 7), forceFullScan = forceFullScan)
+	try:
+		for dirConfig in config["directoryList"]:
+			searchDirectory(dirConfig, RULES)
+		deleteDuplicates()
+		if directoryIndex:
+			directoryIndex.close()
+	finally:
+		if probeCache:
+			probeCache.commit()
+		if hashCache:
+			hashCache.commit()
+
+"""
+Watch the directories with inotify and handle the files as soon as they are written, with
+a periodic reconcile pass over all the directories and a periodic trash cleanup.
+"""
+def runDaemon(config, database, forceFullScan = False):
+	global now, directoryWatcher
+
+	debounceSeconds = config["daemon"].get("debounceSeconds", 30)
+	reconcileSeconds = config["daemon"].get("reconcileHours", 6) * 60 * 60
+	trashCleanupSeconds = config["daemon"].get("trashCleanupHours", 24) * 60 * 60
+
+	directoryWatcher = Inotify()
+	nextReconcile = 0
+	nextTrashCleanup = 0
+	# Directories modified since they were last handled, as (config, recursive, last event time)
+	dirtyList = {}
+
+	try:
+		while True:
+			current = time.time()
+
+			# Reconcile pass, also registering the watches of all the directories
+			if current >= nextReconcile:
+				now = current
+				printAction("DAEMON", "Reconcile pass")
+				statistics.clear()
+				try:
+					scanAll(config, database, forceFullScan)
+					printStatistics()
+					forceFullScan = False
+				# Retried by the next reconcile pass
+				except (OSError, sqlite3.Error) as e:
+					printAction("ERROR", "Reconcile pass failed: %s" % (str(e)))
+					pipeline.clear()
+				nextReconcile = current + reconcileSeconds
+
+			if current >= nextTrashCleanup:
+				now = current
+				cleanupTrash(config)
+				nextTrashCleanup = current + trashCleanupSeconds
+
+			# Handle the directories which did not change for a while
+			readyList = sorted([directory for directory, (dirConfig, recursive, lastEvent) in dirtyList.items() if current - lastEvent >= debounceSeconds])
+			if readyList:
+				now = current
+				for directory in readyList:
+					dirConfig, recursive, lastEvent = dirtyList.pop(directory)
+					try:
+						searchDirectory(dirConfig, RULES, directory, recursive=recursive, useIndex=False)
+					# The next reconcile pass handles the directory again
+					except (OSError, sqlite3.Error) as e:
+						printAction("ERROR", "Cannot handle %s: %s" % (directory, str(e)))
+						pipeline.clear()
+				# Duplicates can only be detected among all the files, during the reconcile passes, the hashes are not looked up
+				duplicateCandidates.clear()
+				if probeCache:
+					probeCache.commit()
+				if hashCache:
+					hashCache.reset()
+
+			# Wait for the next event or deadline
+			deadline = min([nextReconcile, nextTrashCleanup] + [lastEvent + debounceSeconds for dirConfig, recursive, lastEvent in dirtyList.values()])
+			for directory, name, mask, dirConfig in directoryWatcher.read(max(deadline - time.time(), 0.1)):
+				# Events were lost, everything must be reconciled
+				if directory is None:
+					nextReconcile = 0
+					continue
+				if mask & (Inotify.IN_DELETE_SELF | Inotify.IN_MOVE_SELF):
+					continue
+				eventTime = time.time()
+				recursive = dirtyList[directory][1] if directory in dirtyList else False
+				dirtyList[directory] = (dirConfig, recursive, eventTime)
+				# New directory, all its content must be handled and watched
+				if mask & Inotify.IN_ISDIR:
+					dirtyList[os.path.join(directory, name)] = (dirConfig, True, eventTime)
+
+	finally:
+		if probeCache:
+			probeCache.commit()
+		# The reconcile passes commit the hashes themselves
+		if hashCache:
+			hashCache.reset()
+		directoryWatcher.close()
+		directoryWatcher = None
+
 # Main
 if __name__ == '__main__':
 
@@ -128,15 +1051,46 @@ if __name__ == '__main__':
 				"path": None,
 				"deleteiOSLivePhoto": True,
 				"deleteTranscodedVideos": True,
-				"deleteExpirationDays": 2
+				"deleteExpirationDays": 2,
+				# Byte identical photos and videos across all the directories with this option
+				"deleteDuplicates": False,
+				# Globs of the files and directories to ignore, in addition to the Synology system directories
+				"exclude": [],
+				# Globs of the files to consider, all if empty
+				"include": [],
+				# Maximum depth of the sub-directories to scan, unlimited if None
+				"maxDepth": None
 			}
 		],
 		"trash": {
 			# Number of days before the file gets deleted from the trash
 			"expirationDays": 7
+		},
+		# Number of videos probed in parallel
+		"probeWorkers": 4,
+		"incremental": {
+			# Only list the directories that changed since the last run
+			"enabled": True,
+			# Number of days between two full scans
+			"fullScanDays": 7
+		},
+		"daemon": {
+			# Seconds without changes before the files of a directory are handled
+			"debounceSeconds": 30,
+			# Hours between two passes over all the directories
+			"reconcileHours": 6,
+			# Hours between two cleanups of the trash
+			"trashCleanupHours": 24
 		}
 	}
 
+	parser = argparse.ArgumentParser(description="Cleanup files within a collection of directories.")
+	parser.add_argument("--full", action="store_true", help="Force a full scan of all the directories.")
+	parser.add_argument("--daemon", action="store_true", help="Keep running and handle the files as soon as they are written.")
+	parser.add_argument("--restore", metavar="DATE", help="Restore the files moved to trash on this date (%s)." % (TRASH_BUCKET_FORMAT.replace("%", "%%")))
+	parser.add_argument("--restore-prefix", metavar="PATH", help="Only restore the files within this path.")
+	args = parser.parse_args()
+
 	# Load the configuration
 	if not os.path.exists(PATH_CONFIG):
 		with open(PATH_CONFIG, 'w') as f:
@@ -145,19 +1099,35 @@ if __name__ == '__main__':
 		configUser = json.load(f)
 		config.update(configUser)
 
+	# Locate the trash of each volume
 	for dirConfig in config["directoryList"]:
+		if dirConfig["path"] and os.path.exists(dirConfig["path"]):
+			getTrashRoot(dirConfig["path"], os.stat(dirConfig["path"]).st_dev)
 
-		# Handle iOS live photos and delete them
-		if "deleteiOSLivePhoto" in dirConfig and dirConfig["deleteiOSLivePhoto"]:
-			searchDirectory(dirConfig, '.*\.MOV$', handleiOSLivePhoto)
+	if args.restore:
+		restoreTrash(config, args.restore, args.restore_prefix)
+		sys.exit(0)
 
-		# Cleanup transcoded videos
-		if "deleteTranscodedVideos" in dirConfig and dirConfig["deleteTranscodedVideos"]:
-			searchDirectory(dirConfig, '.*\((low|medium|high)\).*', moveToTrashIfOld)
+	database = sqlite3.connect(PATH_CACHE)
+	probeCache = FileCache(database, "probe", ["duration REAL", "decision TEXT"])
+	hashCache = FileCache(database, "hash", ["partial BLOB", "full BLOB"])
+	pipeline = Pipeline(config["probeWorkers"])
+	try:
+		if args.daemon:
+			# Stop gracefully when the service is stopped
+			signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+			runDaemon(config, database, forceFullScan = args.full)
+		else:
+			scanAll(config, database, forceFullScan = args.full)
+	finally:
+		pipeline.close()
+		database.close()
 
 	# Delete old files in trash
 	cleanupTrash(config)
 
+	printStatistics()
+
 	# This will force sending an email if something happen
 	if atLeastOneAction:
 		sys.exit(1)
@@ -2,86 +2,447 @@
 # -*- coding: iso-8859-15 -*-
 
 import os
+import re
 import sys
+import argparse
 import json
+import time
+import random
 import socket
 import pathlib
+import threading
+import collections
+import concurrent.futures
 from datetime import datetime
-from urllib.request import urlopen, Request
-from urllib.error import HTTPError
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+import http.client
 import base64
+import hashlib
+import shutil
 import subprocess
 
 CURRENT_DIRECTORY_PATH = os.path.realpath(os.path.dirname(__file__))
 PATH_CONFIG = os.path.join(CURRENT_DIRECTORY_PATH, ".git-backup.json")
 PATH_LOG = os.path.join(CURRENT_DIRECTORY_PATH, "git-backup.log")
+PATH_STATE = os.path.join(CURRENT_DIRECTORY_PATH, ".git-backup-state.json")
+PATH_API_CACHE = os.path.join(CURRENT_DIRECTORY_PATH, ".git-backup-api.json")
+PATH_FOLDER_CACHE = os.path.join(CURRENT_DIRECTORY_PATH, ".git-backup-folder.json")
+PATH_JOURNAL = os.path.join(CURRENT_DIRECTORY_PATH, ".git-backup-journal.jsonl")
+# Number of consecutive rate limited responses for a Github API page before giving up
+GITHUB_RATE_LIMIT_RETRIES = 5
+
+# Backups run concurrently, log lines must not be interleaved
+logLock = threading.Lock()
 
 def printLog(type, message):
-	print("%s\t%s" % (type, message))
-	with open(PATH_LOG, "a") as myfile:
-		myfile.write("[%s]\t%s\t%s\n" % (str(datetime.now()), type, message))
+	with logLock:
+		print("%s\t%s" % (type, message))
+		with open(PATH_LOG, "a") as myfile:
+			myfile.write("[%s]\t%s\t%s\n" % (str(datetime.now()), type, message))
 	atLeastOneAction = True
 
+class RepoState:
+	"""
+	State of each repository (remote refs at its last backup, last fetch, maintenance), persisted between runs.
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+		self.data = {}
+		if os.path.exists(path):
+			with open(path, "r") as f:
+				self.data = json.load(f)
+
+	def get(self, repoPath, key = "refs"):
+		with self.lock:
+			return self.data.get(repoPath, {}).get(key)
+
+	def set(self, repoPath, value, key = "refs"):
+		with self.lock:
+			self.data.setdefault(repoPath, {})[key] = value
+
+	def list(self):
+		with self.lock:
+			return list(self.data.keys())
+
+	def save(self):
+		with self.lock:
+			with open(self.path + ".tmp", "w") as f:
+				f.write(json.dumps(self.data, sort_keys=True, indent=4, separators=(',', ': ')))
+			os.replace(self.path + ".tmp", self.path)
+
+class ApiCache:
+	"""
+	API pages with their ETag, persisted between runs to revalidate them with conditional requests.
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.data = {}
+		if os.path.exists(path):
+			with open(path, "r") as f:
+				self.data = json.load(f)
+
+	def get(self, key):
+		return self.data.get(key)
+
+	def set(self, key, etag, content, nextUrl):
+		self.data[key] = {"etag": etag, "content": content, "next": nextUrl}
+
+	def save(self):
+		with open(self.path + ".tmp", "w") as f:
+			f.write(json.dumps(self.data, sort_keys=True))
+		os.replace(self.path + ".tmp", self.path)
+
+class FolderCache:
+	"""
+	Origin of the local checkouts, keyed by their git config file and invalidated by its modification time.
+	Only the checkouts seen during the run are saved, the removed ones are dropped.
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.data = {}
+		self.seenSet = set()
+		if os.path.exists(path):
+			with open(path, "r") as f:
+				self.data = json.load(f)
+
+	def get(self, configPath, mtime):
+		self.seenSet.add(configPath)
+		entry = self.data.get(configPath)
+		return entry["origin"] if entry and entry["mtime"] == mtime else None
+
+	def set(self, configPath, mtime, origin):
+		self.seenSet.add(configPath)
+		self.data[configPath] = {"mtime": mtime, "origin": origin}
+
+	def save(self):
+		self.data = {configPath: entry for configPath, entry in self.data.items() if configPath in self.seenSet}
+		with open(self.path + ".tmp", "w") as f:
+			f.write(json.dumps(self.data, sort_keys=True))
+		os.replace(self.path + ".tmp", self.path)
+
+class Journal:
+	"""
+	Journal of the runs, one JSON record per line with the state of each repository (pending, done or failed),
+	its duration, the bytes fetched and the error. A run without end record was interrupted, the next run
+	resumes it and skips the repositories already done.
+	"""
+	def __init__(self, path, keepRuns, resumeHours):
+		self.path = path
+		self.lock = threading.Lock()
+		recordList = Journal.read(path)
+		runList = list(dict.fromkeys(record["run"] for record in recordList))
+
+		self.doneSet = set()
+		lastRun = runList[-1] if runList else None
+		# An old interrupted run is not resumed, its repositories would be skipped while outdated
+		if lastRun and recordList[-1]["time"] > time.time() - resumeHours * 3600 \
+				and not any(record["run"] == lastRun and record.get("event") == "end" for record in recordList):
+			self.run = lastRun
+			self.doneSet = {record["name"] for record in recordList if record["run"] == lastRun and record.get("state") == "done"}
+			printLog("INFO", "Resuming interrupted run {}, {} repositories already done".format(lastRun, len(self.doneSet)))
+		else:
+			# Down to the microsecond, runs started within the same second must not share their records
+			self.run = datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+		# Only keep the most recent runs, a truncated record left by a crash is dropped as well
+		keepSet = set(runList[-keepRuns:] + [self.run])
+		with open(self.path + ".tmp", "w") as f:
+			for record in recordList:
+				if record["run"] in keepSet:
+					f.write(json.dumps(record) + "\n")
+		os.replace(self.path + ".tmp", self.path)
+
+		self.file = open(self.path, "a")
+		self._write({"event": "resume" if self.doneSet else "start"})
+
+	@staticmethod
+	def read(path):
+		recordList = []
+		if os.path.exists(path):
+			with open(path, "r") as f:
+				for line in f:
+					try:
+						recordList.append(json.loads(line))
+					except ValueError:
+						pass
+		return recordList
+
+	def _write(self, record):
+		record.update({"run": self.run, "time": time.time()})
+		with self.lock:
+			self.file.write(json.dumps(record) + "\n")
+			self.file.flush()
+
+	def isDone(self, name):
+		return name in self.doneSet
+
+	def add(self, name, state, **kwargs):
+		kwargs.update({"name": name, "state": state})
+		self._write(kwargs)
+
+	def close(self):
+		self._write({"event": "end"})
+		self.file.close()
+
+# State of the repositories, disabled if None.
+repoState = None
+# Repositories which remote refs did not change are not fetched.
+skipUnchanged = False
+# Cache of the API pages, disabled if None.
+apiCache = None
+# Cache of the origin of the local checkouts, disabled if None.
+folderCache = None
+
+class Pool:
+	"""
+	Backup repositories concurrently, with a limit of concurrent backups per host and a timeout
+	per repository. The backups of a host beyond its limit wait in a queue without holding a
+	worker. Failures are collected with the timing of each repository instead of aborting the
+	whole run.
+	"""
+	def __init__(self, config, journal = None):
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = config.get("workers", 4))
+		self.journal = journal
+		self.workersPerHost = config.get("workersPerHost", 2)
+		self.timeout = config.get("timeout", 3600)
+		self.runningByHost = collections.Counter()
+		self.pendingByHost = {}
+		self.lock = threading.Lock()
+		self.futureList = []
+
+	def _backup(self, name, function, args, kwargs):
+		start = time.monotonic()
+		result = {"name": name, "status": "success", "action": None, "bytes": 0, "error": None}
+		try:
+			result["action"], result["bytes"] = function(*args, deadline = start + self.timeout, **kwargs)
+		except subprocess.TimeoutExpired as e:
+			result.update({"status": "timeout", "error": "Timeout after {}s".format(self.timeout)})
+		except Exception as e:
+			result.update({"status": "failed", "error": str(e)})
+		result["duration"] = time.monotonic() - start
+		if result["error"]:
+			printLog("ERROR", "Repository '{}' failed to backup: {}".format(name, result["error"]))
+		if self.journal:
+			self.journal.add(name, "done" if result["status"] == "success" else "failed", action = result["action"],
+					duration = result["duration"], bytes = result["bytes"], error = result["error"])
+		return result
+
+	def _run(self, host, job):
+		future, name, function, args, kwargs = job
+		try:
+			future.set_result(self._backup(name, function, args, kwargs))
+		except Exception as e:
+			future.set_exception(e)
+		finally:
+			# The slot of the host goes to its next queued backup, if any
+			with self.lock:
+				pendingList = self.pendingByHost.get(host)
+				job = pendingList.popleft() if pendingList else None
+				if job is None:
+					self.runningByHost[host] -= 1
+			if job is not None:
+				self.executor.submit(self._run, host, job)
+
+	def submit(self, name, url, function, *args, **kwargs):
+		"""
+		Queue the backup of a repository, the function is called with the deadline as keyword argument
+		and returns the action taken (skipped, fetched or cloned) and the number of bytes fetched.
+		Repositories already done by an interrupted run are not queued.
+		"""
+		if self.journal:
+			if self.journal.isDone(name):
+				return
+			self.journal.add(name, "pending")
+		job = (concurrent.futures.Future(), name, function, args, kwargs)
+		self.futureList.append(job[0])
+		# Local tasks, like the maintenance, are only limited by the number of workers
+		host = None if url is None else urlparse(url).hostname or "local"
+		with self.lock:
+			if host is not None and self.runningByHost[host] >= self.workersPerHost:
+				self.pendingByHost.setdefault(host, collections.deque()).append(job)
+				return
+			self.runningByHost[host] += 1
+		self.executor.submit(self._run, host, job)
+
+	def wait(self):
+		"""
+		Wait for all the backups and return their results.
+		"""
+		resultList = [future.result() for future in self.futureList]
+		self.futureList = []
+		return resultList
+
+	def shutdown(self):
+		self.executor.shutdown()
+
+class ConnectionPool:
+	"""
+	Persistent HTTP connections per host, reused across requests to save the TCP and TLS handshakes.
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.idleByHost = {}
+
+	def acquire(self, scheme, host, timeout, reuse = True):
+		"""
+		Return an idle connection to the host or a new one, and whether it was reused.
+		The timeout is in seconds, None to wait forever.
+		"""
+		if reuse:
+			with self.lock:
+				idleList = self.idleByHost.get((scheme, host))
+				connection = idleList.pop() if idleList else None
+			if connection:
+				connection.timeout = timeout
+				if connection.sock:
+					connection.sock.settimeout(timeout)
+				return connection, True
+		connectionClass = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+		return connectionClass(host, timeout = timeout), False
+
+	def release(self, scheme, host, connection):
+		with self.lock:
+			self.idleByHost.setdefault((scheme, host), []).append(connection)
+
+	def close(self):
+		with self.lock:
+			for idleList in self.idleByHost.values():
+				for connection in idleList:
+					connection.close()
+			self.idleByHost = {}
+
+class ApiStatistics:
+	"""
+	Latency and retries of the API requests, per endpoint.
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.data = {}
+
+	def add(self, endpoint, duration, nbRetries):
+		with self.lock:
+			entry = self.data.setdefault(endpoint, {"requests": 0, "retries": 0, "duration": 0.})
+			entry["requests"] += 1
+			entry["retries"] += nbRetries
+			entry["duration"] += duration
+
+	def printLog(self):
+		with self.lock:
+			for endpoint, entry in sorted(self.data.items(), key=lambda item: item[1]["duration"], reverse=True):
+				printLog("INFO", "API '{}': {} requests, {} retries, {:.1f}s total, {:.0f}ms average".format(endpoint,
+						entry["requests"], entry["retries"], entry["duration"], entry["duration"] * 1000 / entry["requests"]))
+
+connectionPool = ConnectionPool()
+apiStatistics = ApiStatistics()
+
 class Rest:
-	def __init__(self, endpoint = None, headers = {}):
+	# Statuses worth retrying: 422 Unprocessable Entity (transient on Gitea migrations), 429 Too Many Requests and server errors
+	RETRY_STATUS_LIST = [422, 429, 500, 502, 503, 504]
+	# Statuses for which the server did not process the request, the only ones retried for a POST
+	RETRY_POST_STATUS_LIST = [422, 429]
+
+	def __init__(self, endpoint = None, headers = {}, retries = 4, baseDelay = 0.5, maxDelay = 30, timeout = 60):
 		self.endpoint = endpoint
 		self.headers = headers
+		self.timeout = timeout
+		self.retries = retries
+		self.baseDelay = baseDelay
+		self.maxDelay = maxDelay
 
 	def _prepareRequest(self, path, headers = {}, data = None):
 		data = None if data is None else data.encode()
-		request = Request("{}{}".format(self.endpoint, path) if self.endpoint else path, data)
+		# Absolute URLs, like the pagination links, do not use the endpoint
+		url = "{}{}".format(self.endpoint, path) if self.endpoint and not re.match(r"https?://", path) else path
 		
 		# Update headers
-		newHeader = headers.copy()
+		newHeader = {"User-Agent": "git-backup"}
+		newHeader.update(headers)
 		newHeader.update(self.headers)
-		for key, value in newHeader.items():
-			request.add_header(key, value)
 		
-		return request
-
-	def _sendRequest(self, request, raiseOnError):
-		response = None
-		lastErrorCode = 0
+		return ("POST" if data else "GET"), url, newHeader, data
+
+	@staticmethod
+	def _parseRetryAfter(value):
+		"""
+		Retry-After is either a number of seconds or an HTTP date.
+		"""
+		if value is None:
+			return None
+		try:
+			return float(value)
+		except ValueError:
+			return (parsedate_to_datetime(value) - datetime.now(parsedate_to_datetime(value).tzinfo)).total_seconds()
+
+	def _sendRequest(self, method, url, headers, data, raiseOnError, timeout):
+		parsed = urlparse(url)
+		path = parsed.path + ("?" + parsed.query if parsed.query else "")
+		# A POST is not idempotent: it is not retried once it may have reached the server,
+		# and uses a new connection as a kept alive one may have been closed while sending it.
+		idempotent = (method != "POST")
+		retryStatusList = self.RETRY_STATUS_LIST if idempotent else self.RETRY_POST_STATUS_LIST
+		start = time.monotonic()
+		nbRetries = 0
 		try:
-			retryCounter = 4
-			while retryCounter:
-				retryCounter -= 1
+			while True:
+				connection, reused = connectionPool.acquire(parsed.scheme, parsed.netloc, timeout, reuse = idempotent)
+				retryAfter = None
 				try:
-					response = urlopen(request)
-					break
-
-				except HTTPError as e:
-					lastErrorCode = e.code
-					# 422 Unprocessable Entity - the server understands the content type of the request entity, and the syntax of the request entity is correct, but it was unable to process the contained instructions.
-					if retryCounter and lastErrorCode in [422]:
-						printLog("WARNING", "HTTP error, return code {}, retrying: {}".format(lastErrorCode, str(e)[:200]))
-					else:
-						raise e
-
-				except Exception as e:
-					if retryCounter:
-						printLog("WARNING", "Error: {}, retying".format(str(e)))
+					connection.request(method, path, body = data, headers = headers)
+					response = connection.getresponse()
+					content = response.read()
+					status, responseHeaders = response.status, response.msg
+					if response.will_close:
+						connection.close()
 					else:
-						raise e
-
-			return response.read(), response.getcode()
-
-		except:
-			if raiseOnError:
-				raise
-			output = response.read() if response is not None else ""
-			return output, lastErrorCode
+						connectionPool.release(parsed.scheme, parsed.netloc, connection)
+					error = "HTTP error, return code {}".format(status)
+					if status not in retryStatusList:
+						break
+					retryAfter = self._parseRetryAfter(responseHeaders.get("Retry-After"))
+
+				except (OSError, http.client.HTTPException) as e:
+					connection.close()
+					# The server may have closed a kept alive connection in the meantime
+					if reused and isinstance(e, (ConnectionError, http.client.RemoteDisconnected)):
+						continue
+					content, status, responseHeaders = b"", 0, {}
+					error = "Error: {}".format(str(e) or type(e).__name__)
+					if not idempotent:
+						break
+
+				# Long waits are left to the caller, see githubWaitRateLimit
+				if nbRetries >= self.retries or (retryAfter or 0) > self.maxDelay:
+					break
+				delay = max(retryAfter or 0, random.uniform(0, min(self.maxDelay, self.baseDelay * 2 ** nbRetries)))
+				nbRetries += 1
+				printLog("WARNING", "{} for {} {}, retrying in {:.1f}s".format(error, method, url, delay))
+				time.sleep(delay)
 
 		finally:
-			if response:
-				response.close()
-
-	def json(self, raiseOnError = True, **kwargs):
-		request = self._prepareRequest(**kwargs)
-		response, status = self._sendRequest(request, raiseOnError)
-		if response:
-			return json.loads(response), status
-		return {}, status
+			apiStatistics.add("{} {}{}".format(method, parsed.netloc, parsed.path), time.monotonic() - start, nbRetries)
+
+		if raiseOnError and (status == 0 or status >= 400):
+			raise Exception("{} for {} {}: {}".format(error, method, url, content[:200].decode(errors = "replace")))
+		return content, status, responseHeaders
+
+	def request(self, raiseOnError = True, timeout = False, **kwargs):
+		"""
+		Send a request and return its raw content, status and headers.
+		The timeout in seconds defaults to the one of the client, None waits forever.
+		"""
+		method, url, headers, data = self._prepareRequest(**kwargs)
+		return self._sendRequest(method, url, headers, data, raiseOnError, self.timeout if timeout is False else timeout)
+
+	def json(self, raiseOnError = True, timeout = False, **kwargs):
+		response, status, headers = self.request(raiseOnError, timeout, **kwargs)
+		if not response:
+			return {}, status
+		# Error responses are not always JSON, they are only meant to be logged
+		if status >= 400:
+			return response.decode(errors = "replace"), status
+		return json.loads(response), status
 
 class Gitea:
 	def __init__(self, config):
@@ -95,8 +456,26 @@ class Gitea:
 		self.uid = output["id"]
 		print("Using gitea user ID: {}".format(self.uid))
 
+		# Limit the number of migrations Gitea runs at the same time
+		self.semaphore = threading.BoundedSemaphore(config.get("giteaWorkers", 2))
+		self.lock = threading.Lock()
+		self.repoNameSet = self._listRepositories()
+		print("Found {} existing gitea repositories".format(len(self.repoNameSet)))
+
+	def _listRepositories(self):
+		"""
+		Names of the repositories owned by the user, Gitea names are case insensitive.
+		"""
+		repoNameSet = set()
+		page = 1
+		while True:
+			output, status = self.rest.json(path = "/user/repos?limit=50&page={}".format(page))
+			if not output:
+				return repoNameSet
+			repoNameSet.update(repo["name"].lower() for repo in output if repo["owner"]["id"] == self.uid)
+			page += 1
+
 	def process(self, url, mirror, user = None, password = None):
-		url.split("/")[-1].replace(".git", "")
 		m = {
 			"repo_name": url.split("/")[-1].replace(".git", ""),
 			"clone_addr": url,
@@ -105,17 +484,26 @@ class Gitea:
 			"uid": self.uid,
 		}
 
+		with self.lock:
+			if m["repo_name"].lower() in self.repoNameSet:
+				return
+
 		if bool(user and password):
 			m["auth_username"] = user
 			m["auth_password"] = password
 
 		jsonString = json.dumps(m)
-		output, status = self.rest.json(path = "/repos/migrate", raiseOnError = False, data = jsonString)
+		with self.semaphore:
+			# Gitea clones the repository before answering, this can take a while
+			output, status = self.rest.json(path = "/repos/migrate", raiseOnError = False, timeout = None, data = jsonString)
 
 		if status in [201]:
 			printLog("INFO", "Gitea mirror repository created: '{}'".format(m["repo_name"]))
 		elif status not in [409]:
 			printLog("ERROR", "HTTP error, return code {} while creating repository '{}': {}".format(status, m["repo_name"], str(output)[:200]))
+			return
+		with self.lock:
+			self.repoNameSet.add(m["repo_name"].lower())
 
 class Hooks:
 	def __init__(self, config):
@@ -127,7 +515,7 @@ class Hooks:
 		for hook in self.hooks:
 			hook.process(**kwargs)
 
-def githubBackup(config):
+def githubBackup(config, pool):
 	"""
 	Backup all Github repositories (public and private)
 	"""
@@ -140,76 +528,429 @@ def githubBackup(config):
 	tokenStr = "{}/token:{}".format(config["user"], config["token"])
 	tokenBytes = tokenStr.encode("ascii")
 	base64string = base64.b64encode(tokenBytes).decode("ascii").replace("\n", "")
-	repoList, status = Rest().json(path = "https://api.github.com/user/repos?per_page=100", headers = {
+	rest = Rest(endpoint = config.get("githubApi", "https://api.github.com"), headers = {
 		"Authorization": "Basic {}".format(base64string)
 	})
-
-	# List the repos
+	repoList = githubList(rest, "/user/repos?per_page=100", ["full_name", "fork", "pushed_at"], cacheKey = config["user"])
+	# List the repos, with the date of their last push to detect the unchanged ones
 	repoUrlList = []
 	for repo in repoList:
 		# Ignore forked repos
 		if (not repo["fork"]) or ("ignoreFork" not in config) or (not config["ignoreFork"]):
-			repoUrlList.append(repo["full_name"])
+			repoUrlList.append((repo["full_name"], repo.get("pushed_at")))
 
 	# Clone the repositories
-	for uri in repoUrlList:
+	for uri, pushedAt in repoUrlList:
 		url = "https://%s:%s@github.com/%s.git" % (config["user"], config["token"], uri)
-		gitBackup(config["path"], url)
-		hooks.process(url = url, mirror = True)
+		pool.submit(uri, url, githubRepositoryBackup, config["path"], url, hooks, "pushed_at:{}".format(pushedAt) if pushedAt else None, mirror = config.get("mirror", False))
+
+def githubWaitRateLimit(headers, status, nbRetries = 0):
+	"""
+	Wait for the rate limit to reset if exhausted. Return True if the request was rejected because of it.
+	Without any reset time, wait with an exponential backoff starting at a minute.
+	"""
+	remaining = headers.get("X-RateLimit-Remaining")
+	retryAfter = headers.get("Retry-After")
+	limited = status in [403, 429] and (remaining == "0" or retryAfter is not None)
+	if limited and nbRetries >= GITHUB_RATE_LIMIT_RETRIES:
+		raise Exception("Github API rate limit still reached after {} retries".format(nbRetries))
+	if retryAfter is not None and limited:
+		waitS = Rest._parseRetryAfter(retryAfter)
+	elif remaining == "0" and headers.get("X-RateLimit-Reset"):
+		waitS = int(headers.get("X-RateLimit-Reset")) - time.time() + 1
+	elif limited:
+		waitS = min(60 * 2 ** nbRetries, 900)
+	else:
+		return False
+	if waitS > 0:
+		printLog("WARNING", "Github API rate limit reached, waiting {:.0f}s".format(waitS))
+		time.sleep(waitS)
+	return limited
+
+def githubList(rest, path, fieldList, cacheKey = ""):
+	"""
+	List all the items of a paginated Github API collection, following the Link headers.
+	Pages are cached with their ETag, an unchanged page costs a 304 which does not count against the rate limit.
+	Only the fields from fieldList are kept.
+	"""
+	itemList = []
+	url = path
+	nbLimited = 0
+	while url:
+		key = "{} {}".format(cacheKey, url)
+		cached = apiCache.get(key) if apiCache else None
+		headers = {"If-None-Match": cached["etag"]} if cached else {}
+		response, status, responseHeaders = rest.request(path = url, raiseOnError = False, headers = headers)
+		if githubWaitRateLimit(responseHeaders, status, nbLimited):
+			nbLimited += 1
+			continue
+		nbLimited = 0
+
+		if status == 304 and cached:
+			content = cached["content"]
+			nextUrl = cached["next"]
+		elif status == 200:
+			content = [{field: item.get(field) for field in fieldList} for item in json.loads(response)]
+			match = re.search(r'<([^>]+)>;\s*rel="next"', responseHeaders.get("Link", ""))
+			nextUrl = match.group(1) if match else None
+			if apiCache and responseHeaders.get("ETag"):
+				apiCache.set(key, responseHeaders.get("ETag"), content, nextUrl)
+		else:
+			raise Exception("Github API error, return code {} while listing '{}'".format(status, url))
+
+		itemList.extend(content)
+		url = nextUrl
+
+	return itemList
+
+def githubRepositoryBackup(path, url, hooks, remoteRefs, deadline = None, mirror = False):
+	"""
+	Backup a single Github repository and mirror it.
+	"""
+	output = gitBackup(path, url, deadline = deadline, remoteRefs = remoteRefs, mirror = mirror)
+	hooks.process(url = url, mirror = True)
+	return output
 
-def gitFolder(config):
+def findGitConfig(directory):
+	"""
+	Path of the config file of a git checkout, following the .git file indirections (worktrees, submodules).
+	Return None if the directory is not a checkout.
+	"""
+	gitPath = os.path.join(directory, ".git")
+	if os.path.isdir(gitPath):
+		return os.path.join(gitPath, "config")
+	if not os.path.isfile(gitPath):
+		return None
+	with open(gitPath, "r") as f:
+		content = f.read().strip()
+	if not content.startswith("gitdir:"):
+		return None
+	gitDir = os.path.join(directory, content[len("gitdir:"):].strip())
+	# Worktrees share the config of the main repository
+	commonDirPath = os.path.join(gitDir, "commondir")
+	if os.path.isfile(commonDirPath):
+		with open(commonDirPath, "r") as f:
+			gitDir = os.path.join(gitDir, f.read().strip())
+	return os.path.normpath(os.path.join(gitDir, "config"))
+
+def readGitOrigin(configPath):
+	"""
+	Read the url of the origin remote from a git config file, without spawning git.
+	"""
+	section = None
+	with open(configPath, "r", errors="replace") as f:
+		for line in f:
+			line = line.strip()
+			if not line or line[0] in "#;":
+				continue
+			match = re.match(r'\[\s*([\w.-]+)(?:\s+"([^"]*)")?\s*\]', line)
+			if match:
+				name, subsection = match.group(1).lower(), match.group(2)
+				# Deprecated [remote.origin] syntax
+				if subsection is None and "." in name:
+					name, subsection = name.split(".", 1)
+				section = (name, subsection)
+				line = line[match.end():].strip()
+			key, _, value = line.partition("=")
+			if section == ("remote", "origin") and key.strip().lower() == "url":
+				return value.strip().strip('"')
+	return ""
+
+def discoverCheckouts(path, maxDepth):
+	"""
+	List the git checkouts under path up to maxDepth levels deep, with their origin.
+	The checkouts are not searched for nested repositories.
+	"""
+	checkoutList = []
+	def walk(directory, depth):
+		try:
+			entryList = [entry for entry in os.scandir(directory) if entry.is_dir(follow_symlinks=False) and entry.name != ".git"]
+		except OSError as e:
+			printLog("WARNING", "Cannot list {}: {}".format(directory, str(e)))
+			return
+		for entry in entryList:
+			configPath = findGitConfig(entry.path)
+			if configPath is None:
+				if depth < maxDepth:
+					walk(entry.path, depth + 1)
+				continue
+			try:
+				mtime = os.stat(configPath).st_mtime_ns
+			except OSError:
+				continue
+			origin = folderCache.get(configPath, mtime) if folderCache else None
+			if origin is None:
+				origin = readGitOrigin(configPath)
+				if folderCache:
+					folderCache.set(configPath, mtime, origin)
+			checkoutList.append((entry.path, origin))
+	walk(path, 1)
+	return checkoutList
+
+def gitFolder(config, pool):
 	"""
 	Backup a whole directory and filter by origin.
 	"""
 
 	hooks = Hooks(config)
 	path = pathlib.Path(config["path"])
-	for directory in os.listdir(path):
-		origin = subprocess.run(["git", "config", "--get", "remote.origin.url"], cwd=path / directory, capture_output=True).stdout.decode().strip()
+	for directory, origin in discoverCheckouts(str(path), config.get("maxDepth", 1)):
 		if config["origin"] not in origin:
 			continue
-		hooks.process(url = str(pathlib.Path(config["pathDocker"]) / directory), mirror = False)
-		gitBackup(path, origin)
+		relativePath = os.path.relpath(directory, str(path))
+		pool.submit(relativePath, origin, folderRepositoryBackup, directory, origin, hooks, str(pathlib.Path(config["pathDocker"]) / relativePath))
 
-def gitBackup(path, url):
+def folderRepositoryBackup(repoPath, url, hooks, hookUrl, deadline = None):
+	"""
+	Backup a single checkout of a folder and mirror it, the checkout is not necessarily named after its origin.
+	"""
+	hooks.process(url = hookUrl, mirror = False)
+	return gitBackup(os.path.dirname(repoPath), url, deadline = deadline, repoPath = repoPath)
+
+def runGit(argList, cwd, deadline = None):
+	"""
+	Run a git command and return its output, raise if it fails or once the deadline is reached.
+	"""
+	timeout = None if deadline is None else max(deadline - time.monotonic(), 1)
+	result = subprocess.run(["git"] + argList, cwd=cwd, capture_output=True, timeout=timeout)
+	if result.returncode != 0:
+		raise Exception("git {} failed with code {}: {}".format(argList[0], result.returncode, result.stderr.decode(errors="replace").strip()[-500:]))
+	return result.stdout.decode().strip()
+
+def getRemoteRefs(url, deadline = None):
+	"""
+	Get a digest of all the refs of a remote repository, without fetching anything.
+	"""
+	output = runGit(["ls-remote", url], cwd=CURRENT_DIRECTORY_PATH, deadline=deadline)
+	return "ls-remote:{}".format(hashlib.sha1(output.encode()).hexdigest())
+
+def migrateToMirror(clonePath, mirrorPath, deadline = None):
+	"""
+	Convert a working tree clone into a bare mirror repository, reusing its objects.
+	"""
+	os.rename(os.path.join(clonePath, ".git"), mirrorPath)
+	runGit(["config", "core.bare", "true"], cwd=mirrorPath, deadline=deadline)
+	runGit(["config", "remote.origin.fetch", "+refs/*:refs/*"], cwd=mirrorPath, deadline=deadline)
+	runGit(["config", "remote.origin.mirror", "true"], cwd=mirrorPath, deadline=deadline)
+	shutil.rmtree(clonePath)
+	printLog("INFO", "Clone %s migrated to mirror %s" % (clonePath, mirrorPath))
+
+def getObjectsSize(repoPath):
+	"""
+	Size in bytes of the object database of a working tree clone or of a bare repository.
+	"""
+	objectsPath = os.path.join(repoPath, ".git", "objects")
+	if not os.path.isdir(objectsPath):
+		objectsPath = os.path.join(repoPath, "objects")
+	size = 0
+	for directory, _, fileList in os.walk(objectsPath):
+		for fileName in fileList:
+			try:
+				size += os.lstat(os.path.join(directory, fileName)).st_size
+			except OSError:
+				pass
+	return size
+
+def gitBackup(path, url, deadline = None, remoteRefs = None, mirror = False, repoPath = None):
 	"""
-	Backing up git repository
+	Backing up git repository, it is skipped if its remote refs did not change since the last backup.
+	In mirror mode, all the refs are stored in a bare repository (<name>.git) updated by fetch/prune.
+	The repository is <path>/<name of url> unless an existing checkout is given as repoPath.
+	Return the action taken and the growth in bytes of the object database.
 	"""
-	repoPath = os.path.join(path, os.path.splitext(os.path.basename(url))[0])
+	name = os.path.splitext(os.path.basename(url))[0]
+	if repoPath is None:
+		repoPath = os.path.join(path, name)
+
+	if mirror:
+		clonePath = repoPath
+		repoPath = clonePath + ".git"
+		if not os.path.exists(repoPath) and os.path.isdir(os.path.join(clonePath, ".git")):
+			migrateToMirror(clonePath, repoPath, deadline=deadline)
 	
 	retryCounter = 4
 	while retryCounter:
 		retryCounter -= 1
 
 		try:
-			# If file exists, do a git pull
+			if skipUnchanged and remoteRefs is None:
+				remoteRefs = getRemoteRefs(url, deadline=deadline)
+
+			# If file exists, do a git pull (or a fetch for mirrors)
 			if os.path.exists(repoPath):
-				branch = subprocess.run(["git", "branch", "--show-current"], cwd=repoPath, capture_output=True).stdout.decode().strip()
-				subprocess.check_call(["git", "pull", "-X", "theirs", url], cwd=repoPath)
-				subprocess.check_call(["git", "clean", "-fd"], cwd=repoPath)
+				if skipUnchanged and repoState.get(repoPath) == remoteRefs:
+					return "skipped", 0
+				sizeBefore = getObjectsSize(repoPath)
+				if mirror:
+					runGit(["fetch", "--prune", url, "+refs/*:refs/*"], cwd=repoPath, deadline=deadline)
+				else:
+					runGit(["pull", "-X", "theirs", url], cwd=repoPath, deadline=deadline)
+					runGit(["clean", "-fd"], cwd=repoPath, deadline=deadline)
+				action = "fetched"
 			else:
-				subprocess.check_call(["git", "clone", url], cwd=path)
+				sizeBefore = 0
+				runGit(["clone", "--mirror", url, name + ".git"] if mirror else ["clone", url, os.path.basename(repoPath)], cwd=path, deadline=deadline)
+				action = "cloned"
 			break
 
+		except subprocess.TimeoutExpired:
+			raise
+
 		except Exception as e:
 			printLog("ERROR", "git command for %s failed: %s" % (repoPath, str(e)))
 			if not retryCounter:
 				raise
 			printLog("INFO", "retrying...")
 
+	# Refs read before the update, a change in between will be fetched by the next run
+	if repoState:
+		repoState.set(repoPath, remoteRefs)
+		repoState.set(repoPath, time.time(), "fetched")
+	# Can be negative if git packed loose objects in the meantime
+	return action, max(getObjectsSize(repoPath) - sizeBefore, 0)
+
+def countObjects(repoPath, deadline = None):
+	"""
+	Number of loose objects and of packs of a repository.
+	"""
+	output = runGit(["count-objects", "-v"], cwd=repoPath, deadline=deadline)
+	values = dict(line.split(": ", 1) for line in output.splitlines())
+	return int(values["count"]), int(values["packs"])
+
+def maintainRepository(repoPath, config, deadline = None):
+	"""
+	Keep the object database of a repository compact so its next fetches stay fast: the loose objects are
+	packed (and all the packs consolidated once there are too many), the unreachable objects pruned and the
+	commit-graph and multi-pack-index written.
+	It only happens once the loose objects or packs reach their limit, or if the last maintenance is too old.
+	"""
+	entry = repoState.get(repoPath, "maintenance") or {}
+	nbLoose, nbPacks = countObjects(repoPath, deadline=deadline)
+	now = time.time()
+	isDue = now - entry.get("time", 0) > config.get("days", 7) * 86400
+	tooManyPacks = nbPacks >= config.get("packs", 20)
+	if not isDue and not tooManyPacks and nbLoose < config.get("looseObjects", 1000):
+		repoState.set(repoPath, dict(entry, checked=now, objects=nbLoose, packs=nbPacks), "maintenance")
+		return "checked", 0
+
+	runGit(["repack", "-d", "-l"] + (["-a"] if tooManyPacks else []), cwd=repoPath, deadline=deadline)
+	runGit(["prune", "--expire", "2.weeks.ago"], cwd=repoPath, deadline=deadline)
+	runGit(["commit-graph", "write", "--reachable", "--split"], cwd=repoPath, deadline=deadline)
+	runGit(["multi-pack-index", "write"], cwd=repoPath, deadline=deadline)
+
+	nbLooseAfter, nbPacksAfter = countObjects(repoPath, deadline=deadline)
+	printLog("INFO", "Maintenance of {}: {} loose objects and {} packs, was {} and {}".format(repoPath, nbLooseAfter, nbPacksAfter, nbLoose, nbPacks))
+	repoState.set(repoPath, {"time": now, "checked": now, "objects": nbLooseAfter, "packs": nbPacksAfter}, "maintenance")
+	return "maintained", 0
+
+def scheduleMaintenance(config, pool):
+	"""
+	Queue the maintenance of the repositories fetched since they were last checked.
+	"""
+	for repoPath in repoState.list():
+		checked = (repoState.get(repoPath, "maintenance") or {}).get("checked", 0)
+		if (repoState.get(repoPath, "fetched") or 0) > checked and os.path.isdir(repoPath):
+			pool.submit(repoPath, None, maintainRepository, repoPath, config)
+
+def printSummary(resultList, duration):
+	"""
+	Print the outcome of the backups and the slowest repositories.
+	"""
+	failedList = [result for result in resultList if result["status"] != "success"]
+	printLog("INFO", "{} repositories backed up, {} failed in {:.1f}s".format(len(resultList) - len(failedList), len(failedList), duration))
+	actionList = [result["action"] for result in resultList]
+	printLog("INFO", "{} skipped (unchanged), {} fetched, {} cloned".format(actionList.count("skipped"), actionList.count("fetched"), actionList.count("cloned")))
+	for result in failedList:
+		printLog("INFO", "Failed: '{}' ({}, {:.1f}s): {}".format(result["name"], result["status"], result["duration"], result["error"]))
+	printLog("INFO", "{:.1f} MiB fetched".format(sum(result["bytes"] for result in resultList) / 1024 / 1024))
+	for result in sorted(resultList, key=lambda result: result["duration"], reverse=True)[:5]:
+		printLog("INFO", "Slowest: '{}' in {:.1f}s".format(result["name"], result["duration"]))
+
+def printReport(path, nbRuns):
+	"""
+	Print the slowest and the most failing repositories of the recent runs from the journal.
+	"""
+	recordList = Journal.read(path)
+	runList = list(dict.fromkeys(record["run"] for record in recordList))[-nbRuns:]
+	statsByName = {}
+	for record in recordList:
+		if record["run"] not in runList or record.get("state") not in ["done", "failed"]:
+			continue
+		stats = statsByName.setdefault(record["name"], {"runs": 0, "failures": 0, "durations": [], "bytes": 0, "error": None})
+		stats["runs"] += 1
+		stats["durations"].append(record["duration"])
+		stats["bytes"] += record["bytes"]
+		if record["state"] == "failed":
+			stats["failures"] += 1
+			stats["error"] = record["error"]
+
+	print("{} runs, {} repositories".format(len(runList), len(statsByName)))
+	print("\nSlowest repositories (average duration over the runs):")
+	for name, stats in sorted(statsByName.items(), key=lambda item: sum(item[1]["durations"]) / item[1]["runs"], reverse=True)[:10]:
+		print("  {:8.1f}s (max {:.1f}s, {:.1f} MiB fetched)  {}".format(sum(stats["durations"]) / stats["runs"], max(stats["durations"]),
+				stats["bytes"] / 1024 / 1024, name))
+	print("\nMost failing repositories:")
+	failingList = [item for item in statsByName.items() if item[1]["failures"]]
+	if not failingList:
+		print("  none")
+	for name, stats in sorted(failingList, key=lambda item: item[1]["failures"], reverse=True)[:10]:
+		print("  {}/{} runs failed  {}: {}".format(stats["failures"], stats["runs"], name, (stats["error"] or "").replace("\n", " ")[:200]))
+
 # Main
 if __name__ == '__main__':
 
+	parser = argparse.ArgumentParser(description="Backup Git repositories.")
+	subparsers = parser.add_subparsers(dest="command")
+	subparsers.add_parser("run", help="Backup the repositories (default).")
+	parserReport = subparsers.add_parser("report", help="Print the slowest and most failing repositories of the recent runs.")
+	parserReport.add_argument("--runs", type=int, default=10, help="Number of recent runs to consider.")
+	args = parser.parse_args()
+
+	if args.command == "report":
+		printReport(PATH_JOURNAL, args.runs)
+		sys.exit(0)
+
 	config = {
+		# Number of repositories backed up concurrently
+		"workers": 4,
+		# Maximum number of concurrent backups on the same host
+		"workersPerHost": 2,
+		# Maximum duration in seconds of the backup of a repository
+		"timeout": 3600,
+		# Skip the repositories which remote refs did not change since the last backup
+		"skipUnchanged": True,
+		# Maintenance of the repositories after the backups, to keep the fetches fast
+		"maintenance": {
+			"enabled": True,
+			# Maintain a repository once it has this many loose objects or packs (all the packs are then consolidated)
+			"looseObjects": 1000,
+			"packs": 20,
+			# Maintain a fetched repository if its last maintenance is older than this number of days
+			"days": 7
+		},
+		# Number of runs kept in the journal
+		"journalRuns": 30,
+		# An interrupted run is resumed by the next one if it happens within this number of hours
+		"resumeHours": 12,
 		"repos": [
 			#{
 			#	"type": "github",
 			#	"user": USERNAME,
 			#	"token": API_TOKEN,
 			#	"ignoreFork": True,
+			#	"githubApi": "https://api.github.com",
 			#	"path": ABSOUTE_PATH,
+			#	"mirror": False, # Store bare mirrors with all the refs instead of working tree clones
 			#	"giteaEndpoint": "http://localhost:6008",
-			#	"giteaToken": API_TOKEN
+			#	"giteaToken": API_TOKEN,
+			#	"giteaWorkers": 2 # Maximum number of concurrent migrations
+			#},
+			#{
+			#	"type": "folder",
+			#	"path": ABSOUTE_PATH,
+			#	"origin": ORIGIN_FILTER,
+			#	"pathDocker": ABSOUTE_PATH_IN_GITEA,
+			#	"maxDepth": 1 # Levels of sub-directories searched for checkouts
 			#}
 		]
 	}
@@ -222,6 +963,15 @@ if __name__ == '__main__':
 		configUser = json.load(f)
 		config.update(configUser)
 
+	repoState = RepoState(PATH_STATE)
+	skipUnchanged = config["skipUnchanged"]
+	apiCache = ApiCache(PATH_API_CACHE)
+	folderCache = FolderCache(PATH_FOLDER_CACHE)
+
+	journal = Journal(PATH_JOURNAL, config["journalRuns"], config["resumeHours"])
+	start = time.monotonic()
+	pool = Pool(config, journal)
+	nbFailedConfigs = 0
 	for repo in config["repos"]:
 		try:
 			if "path" not in repo:
@@ -232,14 +982,39 @@ if __name__ == '__main__':
 				os.makedirs(repo["path"])
 
 			if repo["type"] == "github":
-				githubBackup(repo)
+				githubBackup(repo, pool)
 			elif repo["type"] == "git":
-				gitBackup(repo["path"], url)
+				pool.submit(repo["url"], repo["url"], gitBackup, repo["path"], repo["url"], mirror = repo.get("mirror", False))
 			# This option must be enabled: IMPORT_LOCAL_PATHS = true
 			elif repo["type"] == "folder":
-				gitFolder(repo)
+				gitFolder(repo, pool)
 			else:
 				raise Exception("Unknown repository type \"" + repo["type"] + "\"")
 		except Exception as e:
 			printLog("ERROR", "Repository failed to backup: %s" % (str(e)))
-			raise e
+			nbFailedConfigs += 1
+
+	resultList = pool.wait()
+	pool.shutdown()
+
+	# Maintenance only starts once all the fetches are done, with the same number of workers
+	maintenanceList = []
+	if config["maintenance"].get("enabled", True):
+		pool = Pool(config)
+		scheduleMaintenance(config["maintenance"], pool)
+		maintenanceList = pool.wait()
+		pool.shutdown()
+
+	repoState.save()
+	apiCache.save()
+	folderCache.save()
+	printSummary(resultList, time.monotonic() - start)
+	actionList = [result["action"] for result in maintenanceList]
+	printLog("INFO", "{} repositories maintained, {} checked, {} failed".format(actionList.count("maintained"), actionList.count("checked"),
+			len([result for result in maintenanceList if result["status"] != "success"])))
+	apiStatistics.printLog()
+	journal.close()
+	connectionPool.close()
+
+	if nbFailedConfigs or any(result["status"] != "success" for result in resultList):
+		sys.exit(1)
@@ -1,5 +1,7 @@
 #!/usr/bin/python3
 
+import argparse
+import os
 import pathlib
 import subprocess
 import sys
@@ -8,30 +10,96 @@ import json
 import time
 import typing
 import datetime
+import fcntl
+import queue
+import socket
+import threading
 
 scriptDirectoryPath = pathlib.Path(__file__).parent.resolve()
 configPath = scriptDirectoryPath / "vpn-reconnect.json"
+eventsPath = scriptDirectoryPath / "vpn-reconnect.events"
 
-def isHTTPConnection(url: str, timeoutS: int = 5, tries: int = 1) -> None:
-	"""Check if there is a connection to an HTTP server."""
+# Timeout of the first probe, doubled at each try.
+PROBE_TIMEOUT_BASE_S = 5
 
-	assert tries > 0, "Number of tries must be at least one."
+def probeTarget(target: str, timeoutS: float) -> None:
+	"""Probe a single target, raise if it cannot be reached.
+
+	Targets written as 'tcp://host:port' are probed with a TCP connection,
+	the others with an HTTPS HEAD request.
+	"""
+
+	if target.startswith("tcp://"):
+		host, port = target[len("tcp://"):].rsplit(":", 1)
+		socket.create_connection((host, int(port)), timeout=timeoutS).close()
+		return
+
+	conn = httplib.HTTPSConnection(target.replace("https://", "", 1), timeout=timeoutS)
+	try:
+		conn.request("HEAD", "/")
+		conn.getresponse()
+	finally:
+		conn.close()
+
+def probeTargets(targets: typing.List[str], timeoutS: float, quorum: int) -> bool:
+	"""Probe all the targets concurrently.
+
+	Returns:
+		True as soon as one target is reached, False once a quorum of them failed.
+	"""
+
+	results: "queue.Queue[typing.Tuple[str, float, typing.Optional[str]]]" = queue.Queue()
+
+	def probe(target: str) -> None:
+		start = time.monotonic()
+		try:
+			probeTarget(target, timeoutS)
+			results.put((target, time.monotonic() - start, None))
+		except Exception as e:
+			results.put((target, time.monotonic() - start, str(e) or type(e).__name__))
 
-	isSuccess = False
-	while tries:
+	# Daemon threads, the remaining probes are abandoned once the outcome is known.
+	for target in targets:
+		threading.Thread(target=probe, args=(target, ), daemon=True).start()
 
-		tries -= 1
-		conn = httplib.HTTPSConnection(url, timeout=timeoutS)
+	nbFailures = 0
+	for _ in targets:
 		try:
-			conn.request("HEAD", "/")
-			isSuccess = True
-			break
-		except Exception:
-			pass
-		finally:
-			conn.close()
+			# Name resolution is not bound by the socket timeout.
+			target, latencyS, error = results.get(timeout=timeoutS * 2)
+		except queue.Empty:
+			print(f"PROBE: no answer within {timeoutS * 2:.0f}s")
+			return False
+		if error is None:
+			print(f"PROBE: '{target}' {latencyS * 1000:.0f}ms")
+			return True
+		print(f"PROBE: '{target}' failed after {latencyS * 1000:.0f}ms:", error)
+		nbFailures += 1
+		if nbFailures >= quorum:
+			return False
 
-	return isSuccess
+	return False
+
+def isConnection(targets: typing.Union[str, typing.List[str]], timeoutS: float = 30, tries: int = 1, quorum: typing.Optional[int] = None) -> bool:
+	"""Check if there is a connection to any of the targets.
+
+	The targets are probed concurrently, the timeout of each try starts short and
+	doubles up to timeoutS, with a growing delay between the tries. A try fails once
+	a quorum of targets (by default the majority) cannot be reached.
+	"""
+
+	assert tries > 0, "Number of tries must be at least one."
+
+	targets = [targets] if isinstance(targets, str) else targets
+	quorum = quorum or len(targets) // 2 + 1
+
+	for attempt in range(tries):
+		if probeTargets(targets, min(timeoutS, PROBE_TIMEOUT_BASE_S * 2 ** attempt), quorum):
+			return True
+		if attempt + 1 < tries:
+			time.sleep(2 ** attempt)
+
+	return False
 
 def getDateTime() -> str:
 	"""Get the current date/time as a string."""
@@ -82,10 +150,101 @@ class LogEntry:
 	def isEvent(self, event: str) -> bool:
 		return event in self.events.split(",")
 
+class EventLog:
+	"""Fixed-size ring buffer of log entries stored in a file.
+
+	Each entry is stored as JSON in a slot of SLOT_SIZE bytes. The first slot is the header,
+	with the number of slots, the next slot to write, the last reboot entry without its
+	arguments (so it does not need to be searched) and the time of the last run. An entry is
+	written and synced before the header: an interrupted run never corrupts the previous
+	entries. A slot or header that cannot be decoded (lost on power failure) is ignored.
+	The file is locked from open to close, so overlapping runs do not overwrite each other.
+	"""
+
+	SLOT_SIZE = 256
+
+	def __init__(self, path: pathlib.Path, slots: int = 1024) -> None:
+		self.fd = os.open(str(path), os.O_RDWR | os.O_CREAT, 0o644)
+		self.slots = slots
+		fcntl.flock(self.fd, fcntl.LOCK_EX)
+		self.readHeader()
+
+	def readHeader(self) -> None:
+		"""Load the header from the file, or start a new one."""
+
+		self.header = None
+		if os.fstat(self.fd).st_size >= EventLog.SLOT_SIZE:
+			try:
+				self.header = json.loads(os.pread(self.fd, EventLog.SLOT_SIZE, 0))
+			except ValueError:
+				print("Corrupted event log header, starting a new one.")
+		if not isinstance(self.header, dict):
+			self.header = {"slots": self.slots, "next": 0, "count": 0, "lastReboot": None, "last": None}
+			self.writeHeader()
+
+	@staticmethod
+	def encode(data: typing.Any) -> bytes:
+		raw = json.dumps(data).encode()
+		assert len(raw) < EventLog.SLOT_SIZE, "Entry too large for a slot."
+		return raw.ljust(EventLog.SLOT_SIZE - 1) + b"\n"
+
+	def read(self, index: int) -> typing.Optional[LogEntryStorage]:
+		"""Read the entry of a slot, None if it cannot be decoded."""
+
+		try:
+			return tuple(json.loads(os.pread(self.fd, EventLog.SLOT_SIZE, (1 + index) * EventLog.SLOT_SIZE)))
+		except ValueError:
+			return None
+
+	def writeHeader(self) -> None:
+		os.pwrite(self.fd, EventLog.encode(self.header), 0)
+		os.fsync(self.fd)
+
+	@property
+	def entries(self) -> typing.List[LogEntryStorage]:
+		"""All the entries, the oldest first."""
+
+		slots, count = self.header["slots"], self.header["count"]
+		entries = [self.read((self.header["next"] - count + i) % slots) for i in range(count)]
+		return [storage for storage in entries if storage]
+
+	@property
+	def last(self) -> typing.Optional[LogEntryStorage]:
+		if self.header["count"]:
+			return self.read((self.header["next"] - 1) % self.header["slots"])
+		return None
+
+	@property
+	def lastReboot(self) -> typing.Optional[LogEntryStorage]:
+		return tuple(self.header["lastReboot"]) if self.header["lastReboot"] else None
+
+	def append(self, storage: LogEntryStorage) -> None:
+		"""Add an entry, overwriting the oldest one once full."""
+
+		timestamp, events, args = storage
+		# Long arguments (exception messages) are truncated to fit in a slot.
+		while args and len(json.dumps(storage).encode()) >= EventLog.SLOT_SIZE:
+			args = args[:-16] + "..."
+			storage = (timestamp, events, args)
+
+		os.pwrite(self.fd, EventLog.encode(storage), (1 + self.header["next"]) * EventLog.SLOT_SIZE)
+		# The entry must reach the disk before the header pointing to it.
+		os.fsync(self.fd)
+		self.header["next"] = (self.header["next"] + 1) % self.header["slots"]
+		self.header["count"] = min(self.header["count"] + 1, self.header["slots"])
+		# Without the arguments, the header always fits in its slot.
+		if LogEntry(storage).isEvent(EVENT_REBOOT):
+			self.header["lastReboot"] = (timestamp, events, None)
+		self.writeHeader()
+
+	def close(self) -> None:
+		fcntl.flock(self.fd, fcntl.LOCK_UN)
+		os.close(self.fd)
+
 class Log:
 
-	def __init__(self, data: typing.List[LogEntryStorage]) -> None:
-		self.data = data
+	def __init__(self, events: EventLog) -> None:
+		self.events = events
 		self.force = False
 		self.toWrite = []
 
@@ -93,20 +252,15 @@ class Log:
 	def last(self) -> typing.Optional[LogEntry]:
 		"""Get the latest entry from the log."""
 
-		if self.data:
-			return LogEntry(self.data[-1])
-		return None
+		storage = self.events.last
+		return LogEntry(storage) if storage else None
 
 	@property
 	def lastReboot(self) -> typing.Optional[LogEntry]:
-		"""Get the latest entry from the log."""
-
-		for storage in reversed(self.data):
-			entry = LogEntry(storage)
-			if entry.isEvent(EVENT_REBOOT):
-				return entry
+		"""Get the latest reboot entry from the log."""
 
-		return None
+		storage = self.events.lastReboot
+		return LogEntry(storage) if storage else None
 
 	def add(self, event: str, args: typing.Optional[str] = None, force: bool = False) -> None:
 		"""Add a new event to the list."""
@@ -123,13 +277,15 @@ class Log:
 		events = ",".join([entry.events for entry in self.toWrite])
 		args = ",".join([getDateTime()] + [entry.args for entry in self.toWrite if entry.args])
 
-		# If the previous event is the same, do nothing.
+		# Start from the header on disk, it is locked so it cannot change anymore.
+		self.events.readHeader()
+		# If the previous event is the same, only the time of the run is updated.
+		self.events.header["last"] = getDateTime()
 		if not self.force and self.last and self.last.events == events:
+			self.events.writeHeader()
 			return
 
-		self.data.append(LogEntry.make(events, args).storage)
-		while len(self.data) > 64:
-			self.data.pop(0)
+		self.events.append(LogEntry.make(events, args).storage)
 
 def main(config: typing.Any, log: Log) -> bool:
 	"""Check and maintain the VPN connection.
@@ -140,7 +296,7 @@ def main(config: typing.Any, log: Log) -> bool:
 
 	# Check if there is access to internet.
 	# Reboot if not, it happens that internet is not accessible somehow anymore.
-	if not isHTTPConnection(config["internet"], timeoutS = 30):
+	if not isConnection(config["internet"], timeoutS = 30, tries = 3, quorum = config["quorum"]):
 		log.add(EVENT_NO_INTERNET)
 		return True
 
@@ -157,34 +313,111 @@ def main(config: typing.Any, log: Log) -> bool:
 		log.add(EVENT_RECONNECT_FAILED)
 		return True
 
-	# Reconnect successfully.
+	# Reconnect successfully, always recorded to count the reconnections.
 	if result.returncode == 1:
-		log.add(EVENT_RECONNECT)
+		log.add(EVENT_RECONNECT, force=True)
 
 	# Already connected.
 	if result.returncode == 0:
 		log.add(EVENT_GOOD)
 
 	# Assert that it can reach the remote server.
-	if not isHTTPConnection(config["remote"], timeoutS = 60, tries = 10):
+	if not isConnection(config["remote"], timeoutS = 60, tries = 5, quorum = config["quorum"]):
 		log.add(EVENT_NO_REMOTE)
 		return True
 
 	return False
 
+def report(events: EventLog, days: int) -> None:
+	"""Print the outages and reconnections per day."""
+
+	BAD_EVENTS = (EVENT_NO_INTERNET, EVENT_NO_REMOTE, EVENT_RECONNECT_FAILED)
+
+	since = time.time() - days * 24 * 3600
+	statsPerDay: typing.Dict[str, typing.Dict[str, float]] = {}
+	outageList = []
+	outageStart = None
+
+	def getStats(timestamp: float) -> typing.Dict[str, float]:
+		day = datetime.date.fromtimestamp(timestamp).isoformat()
+		return statsPerDay.setdefault(day, {"outages": 0, "outageS": 0., "reconnects": 0, "reboots": 0})
+
+	def closeOutage(end: float) -> None:
+		getStats(outageStart)["outages"] += 1
+		getStats(outageStart)["outageS"] += end - outageStart
+		outageList.append((outageStart, end - outageStart))
+
+	for storage in events.entries:
+		entry = LogEntry(storage)
+		if entry.timestamp < since:
+			continue
+		isBad = any(entry.isEvent(event) for event in BAD_EVENTS)
+		if isBad and outageStart is None:
+			outageStart = entry.timestamp
+		elif not isBad and outageStart is not None and (entry.isEvent(EVENT_GOOD) or entry.isEvent(EVENT_RECONNECT)):
+			closeOutage(entry.timestamp)
+			outageStart = None
+		if entry.isEvent(EVENT_RECONNECT):
+			getStats(entry.timestamp)["reconnects"] += 1
+		if entry.isEvent(EVENT_REBOOT):
+			getStats(entry.timestamp)["reboots"] += 1
+
+	# Still ongoing.
+	if outageStart is not None:
+		closeOutage(time.time())
+
+	print(f"Last run: {events.header['last']}")
+	print(f"{'Date':<12}{'Outages':>8}{'Duration':>18}{'Reconnects':>12}{'Reboots':>9}")
+	for day, stats in sorted(statsPerDay.items()):
+		print(f"{day:<12}{stats['outages']:>8}{str(datetime.timedelta(seconds=int(stats['outageS']))):>18}{stats['reconnects']:>12}{stats['reboots']:>9}")
+	totalS = sum(durationS for _, durationS in outageList)
+	print(f"{len(outageList)} outage(s) over the last {days} day(s), {datetime.timedelta(seconds=int(totalS))} in total.")
+	for start, durationS in sorted(outageList, key=lambda outage: outage[1], reverse=True)[:5]:
+		print(f"Longest: {datetime.datetime.fromtimestamp(start):%Y-%m-%d %H:%M} for {datetime.timedelta(seconds=int(durationS))}")
+
 if __name__ == '__main__':
 
+	parser = argparse.ArgumentParser(description="Check and maintain the VPN connection.")
+	subparsers = parser.add_subparsers(dest="command")
+	subparsers.add_parser("check", help="Check the connection, reconnect or reboot if needed (default).")
+	parserReport = subparsers.add_parser("report", help="Summarize the outages and reconnections.")
+	parserReport.add_argument("--days", type=int, default=30, help="Number of days to summarize.")
+	args = parser.parse_args()
+
+	events = EventLog(eventsPath)
+	if args.command == "report":
+		report(events, args.days)
+		sys.exit(0)
+
 	# Read the configuration.
 	configRaw = json.loads(configPath.read_text()) if configPath.is_file() else {}
+	defaultTargets = ["8.8.8.8", "tcp://1.1.1.1:443", "tcp://9.9.9.9:443"]
 	config = {
-		"internet": "8.8.8.8",
-		"remote": "8.8.8.8",
-		"logs": []
+		# Targets probed concurrently, a host (HTTPS HEAD request) or 'tcp://host:port' (TCP connection).
+		"internet": list(defaultTargets),
+		"remote": list(defaultTargets),
+		# Number of targets that must fail for a check to fail, by default the majority.
+		"quorum": None
 	}
 	config.update(configRaw)
 
+	# The history used to be stored in the configuration, it is moved to the event log.
+	for storage in config.pop("logs", []):
+		events.append(tuple(storage))
+	config.pop("last", None)
+
+	# The single target used to be the default, it is replaced by the default targets.
+	for key in ("internet", "remote"):
+		if config[key] == "8.8.8.8":
+			config[key] = list(defaultTargets)
+
+	# The configuration is only written if it changes.
+	if config != configRaw:
+		configPath.with_suffix(".tmp").write_text(json.dumps(config, indent=4))
+		os.replace(str(configPath.with_suffix(".tmp")), str(configPath))
+
 	isReboot = False
-	log = Log(config["logs"])
+	log = Log(events)
 	try:
 		isReboot = main(config=config, log=log)
 
@@ -202,8 +435,7 @@ if __name__ == '__main__':
 		if isReboot:
 			log.add(EVENT_REBOOT, force=True)
 		log.write()
-		config["last"] = getDateTime()
-		configPath.write_text(json.dumps(config, indent=4))
+		events.close()
 
 	# Reboot if needed.
 	if isReboot: